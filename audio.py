@@ -0,0 +1,177 @@
+"""Audio helpers for playing sounds without spawning ffmpeg."""
+from __future__ import annotations
+from collections import OrderedDict
+from pathlib import Path
+from typing import Deque, Dict, Iterable, Iterator, List, Sequence, Tuple
+from collections import deque
+import asyncio
+import logging
+import threading
+import numpy as np
+import discord
+from discord.opus import Decoder
+from discord.oggparse import OggError, OggStream
+
+logger = logging.getLogger('ButtonBot.audio')
+
+def demux_opus(fn: Path) -> List[bytes]:
+    """Read an Ogg/Opus file into a list of raw Opus packets.
+
+    The OpusHead and OpusTags header packets are dropped, leaving only
+    audio packets that can be sent to Discord as-is.
+    """
+    with open(fn, 'rb') as f:
+        packets = list(OggStream(f).iter_packets())
+    if not packets or not packets[0].startswith(b'OpusHead'):
+        raise OggError(f'{fn} is not an Ogg/Opus stream')
+    return [packet for packet in packets
+            if not packet.startswith((b'OpusHead', b'OpusTags'))]
+
+class OpusPacketSource(discord.AudioSource):
+    """An audio source that plays already-demuxed Opus packets."""
+
+    def __init__(self, packets: Sequence[bytes]) -> None:
+        self.packets = packets
+        self.index = 0
+
+    def read(self) -> bytes:
+        if self.index >= len(self.packets):
+            return b''
+        packet = self.packets[self.index]
+        self.index += 1
+        return packet
+
+    def is_opus(self) -> bool:
+        return True
+
+def pcm_frames(packets: Iterable[bytes]) -> Iterator[bytes]:
+    """Decode Opus packets into 20ms frames of 16-bit 48kHz stereo PCM."""
+    decoder = Decoder()
+    buf = b''
+    for packet in packets:
+        buf += decoder.decode(packet)
+        while len(buf) >= Decoder.FRAME_SIZE:
+            yield buf[:Decoder.FRAME_SIZE]
+            buf = buf[Decoder.FRAME_SIZE:]
+    if buf: # pad the last partial frame with silence
+        yield buf + bytes(Decoder.FRAME_SIZE - len(buf))
+
+class MixerSource(discord.AudioSource):
+    """An audio source that plays several clips over each other.
+
+    Each 20ms frame is the sum of the current frame of every clip,
+    clipped to 16 bits. No more than ``max_voices`` clips play at once;
+    adding one more cuts off the oldest. The source ends once every clip
+    has finished, after which clips can no longer be added.
+    """
+
+    def __init__(self, max_voices: int) -> None:
+        self.max_voices = max_voices
+        self.voices: Deque[Iterator[bytes]] = deque()
+        self.lock = threading.Lock() # read() runs in the player thread
+        self.closed = False
+
+    def __len__(self) -> int:
+        return len(self.voices)
+
+    def add(self, frames: Iterator[bytes]) -> bool:
+        """Start playing a clip. Returns False if this source has ended."""
+        with self.lock:
+            if self.closed:
+                return False
+            if len(self.voices) >= self.max_voices:
+                self.voices.popleft()
+            self.voices.append(frames)
+            return True
+
+    def read(self) -> bytes:
+        with self.lock:
+            frames: List[bytes] = []
+            for voice in list(self.voices):
+                frame = next(voice, None)
+                if frame is None:
+                    self.voices.remove(voice)
+                else:
+                    frames.append(frame)
+            if not frames:
+                self.closed = True
+                return b''
+        return mix_frames(frames)
+
+    def is_opus(self) -> bool:
+        return False
+
+def mix_frames(frames: Sequence[bytes]) -> bytes:
+    """Sum 16-bit PCM frames of equal length, clipping the result."""
+    if len(frames) == 1:
+        return frames[0]
+    mixed = np.frombuffer(frames[0], dtype=np.int16).astype(np.int32)
+    for frame in frames[1:]:
+        mixed += np.frombuffer(frame, dtype=np.int16)
+    return np.clip(mixed, -32768, 32767).astype(np.int16).tobytes()
+
+class OpusCache:
+    """A byte-bounded LRU cache of demuxed Opus packet lists, keyed by path."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[Path, Tuple[List[bytes], int]] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def invalidate(self, fn: Path) -> None:
+        """Forget the packets of a sound that changed or was removed."""
+        entry = self.entries.pop(Path(fn), None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def put(self, fn: Path, packets: List[bytes]) -> None:
+        fn = Path(fn)
+        self.invalidate(fn)
+        nbytes = sum(map(len, packets))
+        if nbytes > self.max_bytes:
+            return # would evict everything else, not worth caching
+        self.entries[fn] = (packets, nbytes)
+        self.size += nbytes
+        while self.size > self.max_bytes:
+            old_fn, (_, old_bytes) = self.entries.popitem(last=False)
+            self.size -= old_bytes
+            self.evictions += 1
+            logger.debug('Evicted %s (%d bytes) from Opus cache',
+                         old_fn, old_bytes)
+
+    async def get(self, fn: Path) -> List[bytes]:
+        """Get the packets of an Opus file, demuxing it if not cached."""
+        fn = Path(fn)
+        entry = self.entries.get(fn)
+        if entry is not None:
+            self.entries.move_to_end(fn)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        packets = await asyncio.to_thread(demux_opus, fn)
+        self.put(fn, packets)
+        logger.debug('Demuxed %s into %d packets; %r', fn, len(packets), self)
+        return packets
+
+    async def source(self, fn: Path) -> OpusPacketSource:
+        return OpusPacketSource(await self.get(fn))
+
+    def __repr__(self) -> str:
+        return '<OpusCache {}>'.format(' '.join(
+            f'{key}={value}' for key, value in self.stats().items()))
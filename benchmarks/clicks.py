@@ -0,0 +1,278 @@
+"""Benchmark ButtonBot's click handling offline, without Discord.
+
+Usage: python benchmarks/clicks.py [options]
+
+Simulates GUILDS guilds each clicking sound commands RATE times per
+second for DURATION seconds, through the real command callbacks,
+interaction_check, play_in_voice, save_stats and /stats. Discord itself is
+replaced by stand-ins: HTTP calls (defer, edit) take --http-latency, voice
+connects take --connect-latency, and voice clients consume audio packets
+as fast as they can (or in real time with --realtime).
+
+Reports p50/p99 latencies, clicks per second, CPU time and peak memory.
+"""
+from __future__ import annotations
+from pathlib import Path
+from typing import Dict, List, Optional
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import discord
+
+ROOT = Path(__file__).resolve().parent.parent
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--guilds', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=2.0,
+                        help='clicks per second per guild')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--users', type=int, default=20,
+                        help='users clicking in each guild')
+    parser.add_argument('--chat-ratio', type=float, default=0.2,
+                        help='fraction of clicks to send in chat')
+    parser.add_argument('--stats-rate', type=float, default=1.0,
+                        help='/stats calls per second, across all guilds')
+    parser.add_argument('--http-latency', type=float, default=0.05)
+    parser.add_argument('--connect-latency', type=float, default=0.3)
+    parser.add_argument('--realtime', action='store_true',
+                        help='play audio at 20ms per packet')
+    parser.add_argument('--policy', default='queue',
+                        help='playback_policy to benchmark')
+    return parser.parse_args()
+
+### STAND-INS FOR DISCORD ###
+
+class FakeVoiceClient:
+    """Accepts audio like a VoiceClient, sending it nowhere."""
+
+    def __init__(self, channel: FakeVoiceChannel, realtime: bool) -> None:
+        self.channel = channel
+        self.realtime = realtime
+        self.connected = True
+        self.playing: Optional[threading.Event] = None # set to stop
+        self.packets = 0
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    def is_playing(self) -> bool:
+        return self.playing is not None
+
+    async def move_to(self, channel: FakeVoiceChannel) -> None:
+        await asyncio.sleep(ARGS.connect_latency / 2)
+        self.channel = channel
+
+    async def disconnect(self, *, force: bool = False) -> None:
+        self.connected = False
+        self.channel.guild.voice_client = None
+
+    def play(self, source: discord.AudioSource, *, after=None) -> None:
+        if self.playing is not None:
+            raise discord.ClientException('Already playing audio.')
+        self.playing = stop = threading.Event()
+        def run() -> None: # like discord.player.AudioPlayer
+            while not stop.is_set() and source.read():
+                self.packets += 1
+                if self.realtime:
+                    time.sleep(0.02)
+            source.cleanup()
+            self.playing = None
+            if after is not None:
+                after(None)
+        threading.Thread(target=run, daemon=True).start()
+
+    def stop(self) -> None:
+        if self.playing is not None:
+            self.playing.set()
+
+class FakeVoiceChannel:
+    def __init__(self, id: int, guild: FakeGuild) -> None:
+        self.id = id
+        self.guild = guild
+
+    async def connect(self, *, timeout: float) -> FakeVoiceClient:
+        await asyncio.sleep(ARGS.connect_latency)
+        self.guild.voice_client = FakeVoiceClient(self, ARGS.realtime)
+        return self.guild.voice_client
+
+class FakeGuild:
+    def __init__(self, id: int) -> None:
+        self.id = id
+        self.name = f'Guild {id}'
+        self.voice_client: Optional[FakeVoiceClient] = None
+        self.channel = FakeVoiceChannel(id * 10, self)
+
+class FakeVoiceState:
+    def __init__(self, channel: FakeVoiceChannel) -> None:
+        self.channel = channel
+
+class FakeMember(discord.Member):
+    """Passes isinstance() checks for discord.Member."""
+
+    def __init__(self, id: int, channel: FakeVoiceChannel) -> None:
+        self._user = discord.Object(id)
+        self._voice = FakeVoiceState(channel)
+
+    @property
+    def voice(self) -> FakeVoiceState: # type: ignore
+        return self._voice
+
+class FakeAttachment:
+    def __init__(self, filename: str) -> None:
+        expiry = int(time.time()) + 86400
+        self.url = f'https://cdn.discordapp.com/attachments/1/2/{filename}' \
+            f'?ex={expiry:x}'
+
+class FakeMessage:
+    def __init__(self, attachments: List[discord.File]) -> None:
+        self.attachments = [FakeAttachment(f.filename) for f in attachments]
+
+class FakeResponse:
+    async def defer(self, **kwargs) -> None:
+        await asyncio.sleep(ARGS.http_latency)
+
+    async def send_message(self, *args, **kwargs) -> None:
+        await asyncio.sleep(ARGS.http_latency)
+
+class FakeInteraction:
+    """The parts of discord.Interaction that ButtonBot uses."""
+
+    def __init__(self, guild: FakeGuild, command) -> None:
+        self.type = discord.InteractionType.application_command
+        self.guild = guild
+        self.guild_id = guild.id
+        self.user = FakeMember(guild.id * 100000 + random.randrange(ARGS.users),
+                               guild.channel)
+        self.channel = None
+        self.command = command
+        self.response = FakeResponse()
+
+    async def edit_original_response(self, **kwargs) -> FakeMessage:
+        await asyncio.sleep(ARGS.http_latency)
+        return FakeMessage(kwargs.get('attachments', []))
+
+### BENCHMARK ###
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return float('nan')
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+async def click(guild: FakeGuild, chat: bool,
+                latencies: Dict[str, List[float]]) -> None:
+    command = random.choice(main.client.tree.get_commands(guild=None))
+    while command.name in META_COMMANDS:
+        command = random.choice(main.client.tree.get_commands(guild=None))
+    ctx = FakeInteraction(guild, command)
+    start = time.perf_counter()
+    if await main.client.tree.interaction_check(ctx):
+        await command.callback(ctx, chat=chat)
+        kind = 'chat' if chat else 'voice'
+    else:
+        kind = 'rate_limited'
+    latencies[kind].append(time.perf_counter() - start)
+
+async def get_stats(guild: FakeGuild, latencies: Dict[str, List[float]]) -> None:
+    ctx = FakeInteraction(guild, main.stats)
+    start = time.perf_counter()
+    await main.stats.callback(ctx, command=None)
+    latencies['stats'].append(time.perf_counter() - start)
+
+async def run() -> None:
+    await main.client._async_setup_hook()
+    main.client.log_queue = asyncio.Queue()
+    main.client.stats_task = asyncio.create_task(main.client.save_stats())
+    while not hasattr(main.client, 'readers'):
+        await asyncio.sleep(0.01)
+
+    latencies: Dict[str, List[float]] = {
+        'voice': [], 'chat': [], 'rate_limited': [], 'stats': [],
+        'first_packet': []}
+    observe = main.FIRST_PACKET_SECONDS.observe
+    def first_packet(value: float) -> None:
+        latencies['first_packet'].append(value)
+        observe(value)
+    main.FIRST_PACKET_SECONDS.observe = first_packet # type: ignore
+
+    guilds = [FakeGuild(i + 1) for i in range(ARGS.guilds)]
+    clicks_per_second = ARGS.guilds * ARGS.rate
+    tasks: List[asyncio.Task] = []
+    errors: List[BaseException] = []
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    next_stats = start
+    n = 0
+    while (now := time.perf_counter()) - start < ARGS.duration:
+        # catch up to where the schedule says we should be
+        while n < (now - start) * clicks_per_second:
+            tasks.append(asyncio.create_task(click(
+                random.choice(guilds), random.random() < ARGS.chat_ratio,
+                latencies)))
+            n += 1
+        while ARGS.stats_rate and next_stats <= now:
+            tasks.append(asyncio.create_task(
+                get_stats(random.choice(guilds), latencies)))
+            next_stats += 1 / ARGS.stats_rate
+        await asyncio.sleep(0.005)
+    clicking = time.perf_counter() - start
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+            errors.append(result)
+    # wait for queued plays to finish too
+    while not all(player.idle() for player in main.guild_players.values()):
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    # let idle guild players expire, as they would between bursts
+    await asyncio.sleep(main.PLAYBACK_DEDUPE_WINDOW + 0.1)
+    memory = main.memory_report()
+    await main.client.close()
+
+    print(f'{n} clicks in {ARGS.guilds} guilds over {clicking:.2f}s: '
+          f'{n / clicking:.1f} clicks/s, all played after {elapsed:.2f}s')
+    print(f'CPU time {cpu:.2f}s ({cpu / elapsed:.0%} of one core), peak RSS '
+          f'{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB')
+    print(f'{"latency (ms)":<14} {"count":>7} {"p50":>8} {"p99":>8}')
+    for kind, samples in latencies.items():
+        print(f'{kind:<14} {len(samples):>7} '
+              f'{percentile(samples, 0.5) * 1000:>8.1f} '
+              f'{percentile(samples, 0.99) * 1000:>8.1f}')
+    print(f'opus cache: {main.opus_cache!r}')
+    print('memory: ' + ' '.join(f'{key}={value}'
+                                for key, value in memory.items()))
+    if errors:
+        print(f'{len(errors)} clicks failed, first: {errors[0]!r}')
+
+def main_() -> None:
+    global main
+    with tempfile.TemporaryDirectory() as tmp:
+        config = Path(tmp) / 'buttonbot.json'
+        with open(config, 'w') as f:
+            json.dump({
+                'token': 'benchmark',
+                'commit_threshold': 1000,
+                'playback_policy': ARGS.policy,
+            }, f)
+        os.environ['BUTTONBOT_CONFIG'] = str(config)
+        sys.argv[1:] = [] # main.py would take them as the log file
+        sys.path.insert(0, str(ROOT))
+        import main # noqa: E402
+        logging.getLogger('ButtonBot').setLevel(logging.WARNING)
+        main.STATS_FILE = str(Path(tmp) / 'stats.db')
+        asyncio.run(run())
+
+META_COMMANDS = {'hello', 'invite', 'version', 'stats', 'cmd', '-cmd'}
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    main_()
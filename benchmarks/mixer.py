@@ -0,0 +1,54 @@
+"""Benchmark MixerSource: 20ms frames mixed per second by number of voices.
+
+Usage: python benchmarks/mixer.py [max voices] [frames per run]
+
+Decodes sounds/bruh/sound.opus if libopus can be loaded, otherwise mixes
+random noise; either way, only the 48kHz stereo PCM mixing is timed.
+"""
+from pathlib import Path
+import sys
+import time
+import numpy as np
+import discord
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from audio import MixerSource, demux_opus, pcm_frames # noqa: E402
+
+FRAME_SIZE = discord.opus.Decoder.FRAME_SIZE
+REALTIME_FPS = 50 # one frame every 20ms
+
+def clip_frames() -> list:
+    """Get one clip's worth of PCM frames to mix."""
+    if discord.opus.is_loaded() or discord.opus._load_default():
+        fn = Path(__file__).resolve().parent.parent \
+            / 'sounds' / 'bruh' / 'sound.opus'
+        return list(pcm_frames(demux_opus(fn)))
+    print('libopus not found, mixing random noise instead')
+    rng = np.random.default_rng(0)
+    return [rng.integers(-8192, 8192, FRAME_SIZE // 2, dtype=np.int16)
+            .tobytes() for _ in range(50)]
+
+def bench(voices: int, frames: list, nframes: int) -> float:
+    """Mix ``nframes`` frames of ``voices`` looping clips; get frames/sec."""
+    mixer = MixerSource(voices)
+    for i in range(voices):
+        # offset each voice so they're not all the same frame
+        mixer.add(frames[j % len(frames)] for j in range(i, i + nframes))
+    start = time.perf_counter()
+    for _ in range(nframes):
+        mixer.read()
+    return nframes / (time.perf_counter() - start)
+
+def main() -> None:
+    max_voices = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    nframes = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    frames = clip_frames()
+    print(f'{"voices":>6} {"frames/s":>12} {"x realtime":>11}')
+    voices = 1
+    while voices <= max_voices:
+        fps = bench(voices, frames, nframes)
+        print(f'{voices:>6} {fps:>12.0f} {fps / REALTIME_FPS:>11.1f}')
+        voices *= 2
+
+if __name__ == '__main__':
+    main()
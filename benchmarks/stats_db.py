@@ -0,0 +1,125 @@
+"""Benchmark /stats query latency while the stats writer is saturated.
+
+Usage: python benchmarks/stats_db.py [options]
+
+Fills a stats database, then times the queries /stats makes: without
+any writes for reference, then while batches of usage counts are written
+as fast as possible, with the queries sharing the writer's connection (as
+they used to) and with a WAL-mode ReaderPool. Reports p50/p99 latency of
+a whole /stats worth of queries and write throughput.
+"""
+from __future__ import annotations
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+import argparse
+import asyncio
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import statsdb # noqa: E402
+
+QUERIES = [ # what /stats runs, with and without a command
+    ('SELECT used_in_guild_id, usage_count '
+     'FROM global_stats WHERE cmd_name=?', ('cmd',)),
+    ('SELECT usage_count FROM guild_stats '
+     'WHERE cmd_name=? AND guild_id=?', ('cmd', 'guild')),
+    ('SELECT cmd_name, usage_count '
+     'FROM global_totals ORDER BY usage_count DESC', ()),
+    ('SELECT cmd_name, usage_count FROM guild_stats WHERE guild_id=? '
+     'ORDER BY usage_count DESC', ('guild',)),
+]
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--guilds', type=int, default=2000)
+    parser.add_argument('--commands', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=500,
+                        help='usage counts per write')
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help='seconds per mode')
+    parser.add_argument('--readers', type=int, default=2)
+    parser.add_argument('--synchronous', default='NORMAL')
+    return parser.parse_args()
+
+def random_deltas(args: argparse.Namespace,
+                  n: int) -> statsdb.Deltas:
+    return {(f'cmd{random.randrange(args.commands)}',
+             random.randrange(args.guilds)): random.randint(1, 5)
+            for _ in range(n)}
+
+def params(args: argparse.Namespace, names: Tuple[str, ...]) -> Tuple[Any, ...]:
+    values = {'cmd': f'cmd{random.randrange(args.commands)}',
+              'guild': random.randrange(args.guilds)}
+    return tuple(values[name] for name in names)
+
+def percentile(samples: List[float], q: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+async def measure(args: argparse.Namespace, writer, fetchall: Callable[
+        [str, Tuple[Any, ...]], Awaitable[Any]]) -> Dict[str, float]:
+    stop = False
+    writes = 0
+    async def write() -> None:
+        nonlocal writes
+        while not stop and args.batch:
+            half = args.batch // 2
+            await statsdb.write_stats(writer, random_deltas(args, half),
+                                      random_deltas(args, half))
+            writes += 1
+    task = asyncio.create_task(write())
+    latencies: List[float] = []
+    end = time.perf_counter() + args.duration
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        for query, names in QUERIES:
+            await fetchall(query, params(args, names))
+        latencies.append(time.perf_counter() - start)
+    stop = True
+    await task
+    return {
+        'p50': percentile(latencies, 0.5) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'stats/s': len(latencies) / args.duration,
+        'writes/s': writes / args.duration,
+    }
+
+async def main() -> None:
+    args = parse_args()
+    pragmas = {'synchronous': args.synchronous, 'cache_size': -16000,
+               'mmap_size': 64 * 1024 * 1024}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = str(Path(tmp) / 'stats.db')
+        writer = await statsdb.connect(path, pragmas)
+        await statsdb.create_tables(writer)
+        print(f'Filling database with {args.guilds} guilds '
+              f'x {args.commands} commands...')
+        for _ in range(20):
+            await statsdb.write_stats(
+                writer, random_deltas(args, args.guilds * args.commands // 20),
+                random_deltas(args, args.guilds * args.commands // 20))
+
+        async def shared(query: str, params: Tuple[Any, ...]) -> Any:
+            return await writer.execute_fetchall(query, params)
+        readers = await statsdb.ReaderPool.open(path, pragmas, args.readers)
+        results = {
+            'no writes, pool': await measure(
+                argparse.Namespace(**{**vars(args), 'batch': 0}),
+                writer, readers.fetchall),
+            'shared connection': await measure(args, writer, shared),
+            f'reader pool ({args.readers})': await measure(
+                args, writer, readers.fetchall),
+        }
+        await readers.close()
+        await writer.close()
+    print(f'{"/stats queries":<20} {"p50 ms":>8} {"p99 ms":>8} '
+          f'{"stats/s":>8} {"writes/s":>9}')
+    for mode, result in results.items():
+        print(f'{mode:<20} {result["p50"]:>8.2f} {result["p99"]:>8.2f} '
+              f'{result["stats/s"]:>8.1f} {result["writes/s"]:>9.1f}')
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,144 @@
+"""Run ButtonBot as several processes ("clusters") with some shards each.
+
+Usage: python launcher.py [logfile] [--clusters N] [--shards M]
+
+Shards are split evenly between the clusters, which each run main.py
+with their share. Clusters that exit unexpectedly are restarted.
+The launcher itself owns the stats database, writing the usage counts
+sent by every cluster, so that /stats in any of them covers all of them.
+
+Both options can also be set in buttonbot.json, as ``clusters`` and
+``shard_count``; by default, there is one cluster per CPU and as many
+shards as Discord recommends.
+"""
+from __future__ import annotations
+from pathlib import Path
+from typing import Dict, List, Optional
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import aiohttp
+import statsdb
+
+SRCDIR = Path(__file__).resolve().parent
+CONFIG_FILE = os.environ.get('BUTTONBOT_CONFIG', 'buttonbot.json')
+STATS_FILE = 'buttonbot_stats.db'
+os.chdir(SRCDIR)
+
+parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+parser.add_argument('logfile', nargs='?', default=None,
+                    help='log here instead of to stdout; '
+                    'each cluster logs to logfile.N')
+parser.add_argument('--clusters', type=int, default=None)
+parser.add_argument('--shards', type=int, default=None)
+ARGS = parser.parse_args()
+
+if ARGS.logfile is None:
+    log_handler = logging.StreamHandler(sys.stdout)
+else:
+    log_handler = logging.FileHandler(ARGS.logfile, 'a')
+logging.basicConfig(format='{asctime} {levelname}\t {name:19} {message}',
+                    style='{', handlers=[log_handler], level=logging.INFO)
+logger = logging.getLogger('ButtonBot.launcher')
+
+with open(CONFIG_FILE) as f:
+    CONFIG = json.load(f)
+
+async def recommended_shards(token: str) -> int:
+    """Ask Discord how many shards the bot should have."""
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+            'https://discord.com/api/v10/gateway/bot',
+            headers={'Authorization': f'Bot {token}'},
+        ) as response:
+            response.raise_for_status()
+            return (await response.json())['shards']
+
+def split_shards(shard_count: int, clusters: int) -> List[List[int]]:
+    """Split shard IDs into contiguous runs, one per cluster."""
+    clusters = min(clusters, shard_count)
+    return [list(range(i * shard_count // clusters,
+                       (i + 1) * shard_count // clusters))
+            for i in range(clusters)]
+
+class Cluster:
+    """One main.py process, restarted whenever it exits on its own."""
+
+    def __init__(self, index: int, shard_ids: List[int],
+                 env: Dict[str, str]) -> None:
+        self.index = index
+        self.shard_ids = shard_ids
+        self.env = env
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self.stopping = False
+
+    async def run(self) -> None:
+        delay = 1.0
+        while not self.stopping:
+            args = [sys.executable, str(SRCDIR / 'main.py')]
+            if ARGS.logfile is not None:
+                args.append(f'{ARGS.logfile}.{self.index}')
+            logger.info('Starting cluster %s with shards %s',
+                        self.index, self.shard_ids)
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            self.proc = await asyncio.create_subprocess_exec(*args, env={
+                **os.environ, **self.env,
+                'BUTTONBOT_CLUSTER': str(self.index),
+                'BUTTONBOT_SHARD_IDS': ','.join(map(str, self.shard_ids)),
+            }, start_new_session=True) # so ^C only reaches the launcher
+            code = await self.proc.wait()
+            if self.stopping:
+                break
+            # back off if it keeps crashing right away
+            delay = 1.0 if loop.time() - started > 60 else min(delay * 2, 60)
+            logger.warning('Cluster %s exited with %s, restarting in %ss',
+                           self.index, code, delay)
+            await asyncio.sleep(delay)
+        logger.info('Cluster %s stopped', self.index)
+
+    def stop(self) -> None:
+        """Ask the process to shut down cleanly, flushing its stats."""
+        self.stopping = True
+        if self.proc is not None and self.proc.returncode is None:
+            self.proc.send_signal(signal.SIGINT)
+
+async def main() -> None:
+    shard_count: int = ARGS.shards or CONFIG.get('shard_count', None) \
+        or await recommended_shards(CONFIG['token'])
+    cluster_count: int = ARGS.clusters or CONFIG.get('clusters', None) \
+        or os.cpu_count() or 1
+
+    db = await statsdb.connect(STATS_FILE, statsdb.config_pragmas(CONFIG))
+    await statsdb.create_tables(db)
+    writer = statsdb.StatsWriter(db)
+    server = await asyncio.start_server(writer.handle, '127.0.0.1', 0)
+    host, port = server.sockets[0].getsockname()[:2]
+    logger.info('Writing stats for all clusters, listening on %s:%s',
+                host, port)
+
+    env = {
+        'BUTTONBOT_STATS_WRITER': f'{host}:{port}',
+        'BUTTONBOT_SHARD_COUNT': str(shard_count),
+    }
+    clusters = [Cluster(index, shard_ids, env) for index, shard_ids
+                in enumerate(split_shards(shard_count, cluster_count))]
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, lambda: [
+            cluster.stop() for cluster in clusters])
+    try:
+        await asyncio.gather(*(cluster.run() for cluster in clusters))
+    finally:
+        # only once every cluster has sent its last stats
+        server.close()
+        await server.wait_closed()
+        await db.close()
+        logger.info('Wrote %s batches of stats. Goodbye.', writer.batches)
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,45 +1,139 @@
 from __future__ import annotations
-from functools import cache
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from bisect import bisect_left, insort
+from itertools import islice
 import sys
 import os
 from pathlib import Path
 import shutil
+import hashlib
+import io
 import json
 import re
-from typing import Dict, Optional, Tuple, Union
+import resource
+from typing import Awaitable, Callable, Deque, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import queue
+import random
 import traceback
 import asyncio
-from urllib.parse import urlparse
+import time
+from urllib.parse import parse_qs, urlparse
 import aiohttp
 import aiosqlite
 import discord
 from discord import app_commands
 from discord.ext import commands
+from metrics import Registry
+from ratelimit import TokenBuckets
+from watcher import TreeWatcher
+import statsdb
+from audio import MixerSource, OpusCache, OpusPacketSource, pcm_frames
 
 SRCDIR = Path(__file__).resolve().parent
 VERSION = None
-CONFIG_FILE = 'buttonbot.json'
+CONFIG_FILE = os.environ.get('BUTTONBOT_CONFIG', 'buttonbot.json')
 STATS_FILE = 'buttonbot_stats.db'
-LEAVE_DELAY = 1
+# set by launcher.py when this is one of several processes
+CLUSTER: Optional[int] = int(os.environ['BUTTONBOT_CLUSTER']) \
+    if 'BUTTONBOT_CLUSTER' in os.environ else None
+SYNC_FILE = 'buttonbot_sync.json' if CLUSTER is None \
+    else f'buttonbot_sync.{CLUSTER}.json'
 NAME_REGEX = re.compile(r'^[a-z0-9]{1,32}$')
 os.chdir(SRCDIR)
+STARTUP = time.perf_counter()
+
+with open(CONFIG_FILE) as f:
+    CONFIG = json.load(f)
+
+class DroppingQueueHandler(QueueHandler):
+    """Queues records for a QueueListener, dropping them if it falls behind."""
+
+    def __init__(self, maxsize: int) -> None:
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
 
 # logging config
 if len(sys.argv) <= 1 or sys.argv[1].startswith('-'):
     log_handler = logging.StreamHandler(sys.stdout)
 else:
     log_handler = logging.FileHandler(sys.argv[1], 'a')
-logging.basicConfig(format='{asctime} {levelname}\t {name:19} {message}',
-                    style='{', handlers=[log_handler], level=logging.INFO)
+log_handler.setFormatter(logging.Formatter(
+    '{asctime} {levelname}\t {name:19} {message}', style='{'))
+# records are written in a background thread, so that a slow disk never
+# holds up the event loop
+log_queue_handler = DroppingQueueHandler(CONFIG.get('log_queue_size', 10000))
+log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+log_listener = QueueListener(log_queue_handler.queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop) # flushes what's left
+logging.basicConfig(handlers=[log_queue_handler], level=logging.INFO)
 logging.getLogger('discord').setLevel(logging.INFO)
 if '-v' in sys.argv:
     logging.getLogger('discord.app_commands').setLevel(logging.DEBUG)
 logger = logging.getLogger('ButtonBot')
 logger.setLevel(logging.DEBUG)
+# one record per interaction; all, some (a random sample), or none of them,
+# either as readable text or as compact JSON
+interaction_logger = logging.getLogger('ButtonBot.interactions')
+INTERACTION_LOG_SAMPLE: float = CONFIG.get('interaction_log_sample', 1.0)
+INTERACTION_LOG_JSON: bool = \
+    CONFIG.get('interaction_log_format', 'text') == 'json'
 
-with open(CONFIG_FILE) as f:
-    CONFIG = json.load(f)
+STATS_PRAGMAS = statsdb.config_pragmas(CONFIG)
+
+metrics = Registry('buttonbot_')
+COMMAND_SECONDS = metrics.histogram(
+    'command_seconds', 'Time taken to handle a sound command.')
+VOICE_CONNECT_SECONDS = metrics.histogram(
+    'voice_connect_seconds', 'Time taken to get connected to play a sound.')
+FIRST_PACKET_SECONDS = metrics.histogram(
+    'first_packet_seconds', 'Time from click to first audio packet sent.')
+CHAT_UPLOAD_SECONDS = metrics.histogram(
+    'chat_upload_seconds', 'Time taken to upload a sound in chat.')
+TRANSCODE_SECONDS = metrics.histogram(
+    'transcode_seconds', 'Time taken by transcoding subprocesses.',
+    (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0))
+STATS_FLUSH_SECONDS = metrics.histogram(
+    'stats_flush_seconds', 'Time taken to write a batch of stats.')
+TREE_SYNC_SECONDS = metrics.histogram(
+    'tree_sync_seconds', 'Time taken to sync commands with Discord.')
+
+def click_limit(kind: str, rate: float, burst: int) -> Optional[TokenBuckets]:
+    """Make the rate limit on sound commands per user or per guild."""
+    rate = CONFIG.get(f'{kind}_click_rate', rate)
+    if not rate:
+        return None # unlimited
+    return TokenBuckets(rate, CONFIG.get(f'{kind}_click_burst', burst))
+
+USER_CLICKS = click_limit('user', 1.0, 5)
+GUILD_CLICKS = click_limit('guild', 5.0, 20)
+
+def check_rate_limit(ctx: discord.Interaction) -> float:
+    """Count a click against its user's and guild's rate limits.
+
+    Returns 0 if it's allowed, else the seconds until it would be.
+    """
+    now = time.monotonic()
+    limits = [(buckets, key) for buckets, key in (
+        (USER_CLICKS, ctx.user.id), (GUILD_CLICKS, ctx.guild_id),
+    ) if buckets is not None]
+    wait = max((buckets.retry_after(key, now)
+                for buckets, key in limits), default=0.0)
+    if not wait: # only take tokens if every limit allows it
+        for buckets, key in limits:
+            buckets.take(key, now)
+    return wait
 
 async def send_error(method, msg):
     await method(embed=discord.Embed(
@@ -48,7 +142,6 @@ async def send_error(method, msg):
         color=0xff0000
     ))
 
-@cache
 def cmd_guild_id(ctx: discord.Interaction) -> Optional[int]:
     if not isinstance(ctx.command, app_commands.Command):
         return None
@@ -58,9 +151,30 @@ def cmd_guild_id(ctx: discord.Interaction) -> Optional[int]:
         return ctx.guild_id
     return None
 
+def log_interaction(ctx: discord.Interaction) -> None:
+    assert ctx.command is not None
+    if not interaction_logger.isEnabledFor(logging.INFO):
+        return
+    if INTERACTION_LOG_JSON:
+        interaction_logger.info('%s', json.dumps({
+            'user': ctx.user.id,
+            'channel': ctx.channel.id if ctx.channel else None,
+            'guild': ctx.guild_id,
+            'command': ctx.command.qualified_name,
+            'command_guild': cmd_guild_id(ctx),
+        }, separators=(',', ':')))
+    else:
+        interaction_logger.info(
+            'User %s\t(%18d) in channel %s\t(%18d) '
+            'running /%s (belongs to guild %s)',
+            ctx.user, ctx.user.id, ctx.channel,
+            ctx.channel.id if ctx.channel else '(none)',
+            ctx.command.qualified_name, cmd_guild_id(ctx))
+
 class ButtonTree(app_commands.CommandTree):
 
     client: ButtonBot
+    rate_limited: int = 0
 
     async def on_error(self, ctx: discord.Interaction,
                        exc: app_commands.AppCommandError) -> None:
@@ -91,21 +205,47 @@ class ButtonTree(app_commands.CommandTree):
     async def interaction_check(self, ctx: discord.Interaction) -> bool:
         if not isinstance(ctx.command, app_commands.Command):
             return False # we shouldn't have anything other than these
-        logger.info('User %s\t(%18d) in channel %s\t(%18d) '
-                    'running /%s (belongs to guild %s)',
-                    ctx.user, ctx.user.id, ctx.channel,
-                    ctx.channel.id if ctx.channel else '(none)',
-                    ctx.command.qualified_name,
-                    cmd_guild_id(ctx))
+        if ctx.type is discord.InteractionType.autocomplete:
+            return True # only typing, not running it
+        if 'guild_id' in ctx.command.extras: # sound command
+            wait = check_rate_limit(ctx)
+            if wait:
+                # as cheaply as possible; not even logged
+                self.rate_limited += 1
+                await send_error(partial(ctx.response.send_message,
+                                         ephemeral=True),
+                                 f'Slow down! Try again in {wait:.1f}s.')
+                return False
+        if random.random() < INTERACTION_LOG_SAMPLE:
+            log_interaction(ctx)
         self.client.log_queue.put_nowait(ctx)
         return True
 
-class ButtonBot(commands.Bot):
+class ButtonBot(commands.AutoShardedBot):
 
     log_queue: asyncio.Queue[discord.Interaction]
-    db: aiosqlite.Cursor
+    # None if launcher.py writes the stats
+    dbw: Optional[aiosqlite.Connection] = None
+    session: aiohttp.ClientSession
+    # /stats queries, kept off the writer's connection
+    readers: statsdb.ReaderPool
+    stats_task: Optional[asyncio.Task] = None
+    # writes stats for every process when run by launcher.py
+    stats_writer: Optional[statsdb.StatsWriterClient] = None
+    # reloads sounds changed on disk
+    watcher: Optional[TreeWatcher] = None
+    global_deltas: statsdb.Deltas
+    guild_deltas: statsdb.Deltas
+    # (command, guild_id) -> (expiry time, rendered /stats embeds)
+    stats_cache: Dict[Tuple[Optional[str], Optional[int]],
+                      Tuple[float, List[discord.Embed]]]
 
     def __init__(self) -> None:
+        # None lets Discord decide how many shards; all of them run here
+        # unless launcher.py gave this process only some
+        shard_count = os.environ.get('BUTTONBOT_SHARD_COUNT',
+                                     CONFIG.get('shard_count', None))
+        shard_ids = os.environ.get('BUTTONBOT_SHARD_IDS', None)
         super().__init__(
             description='A bot that plays sound effects',
             command_prefix='/',
@@ -113,79 +253,176 @@ class ButtonBot(commands.Bot):
             help_command=None,
             activity=discord.Activity(type=discord.ActivityType.watching, name='/'),
             tree_cls=ButtonTree,
+            shard_count=int(shard_count) if shard_count else None,
+            shard_ids=[int(shard_id) for shard_id in shard_ids.split(',')]
+            if shard_ids else None,
         )
+        self.global_deltas = {}
+        self.guild_deltas = {}
+        self.stats_cache = {}
 
     async def setup_hook(self) -> None:
         self.log_queue = asyncio.Queue()
+        # shared by all downloads so connections and DNS lookups are reused
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=CONFIG.get('http_limit', 100),
+                limit_per_host=CONFIG.get('http_limit_per_host', 8),
+                ttl_dns_cache=CONFIG.get('http_dns_cache_ttl', 300),
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=CONFIG.get('http_timeout', 300),
+                connect=CONFIG.get('http_connect_timeout', 10),
+                sock_read=CONFIG.get('http_read_timeout', 30),
+            ),
+        )
 
         debug_guild_id = CONFIG.get('guild_id', None)
         if debug_guild_id:
-            debug_guild = discord.Object(debug_guild_id)
-            self.tree.copy_global_to(guild=debug_guild)
+            # with its own sounds too, or syncing would remove them
+            register_guild(debug_guild_id)
+        if not CLUSTER: # the first process syncs for everyone
+            await sync_guild(debug_guild_id)
+
+        writer = os.environ.get('BUTTONBOT_STATS_WRITER', None)
+        if writer:
+            host, port = writer.rsplit(':', 1)
+            self.stats_writer = statsdb.StatsWriterClient(host, int(port))
+
+        if CONFIG.get('watch_sounds', True):
+            self.watcher = TreeWatcher(
+                Path('sounds'), reload_sounds,
+                skip=lambda path: path.parts[:1] == (BLOB_ROOT.name,),
+                debounce=CONFIG.get('watch_debounce', 1.0),
+                poll_interval=CONFIG.get('watch_poll_interval', 5.0))
+            self.watcher.start()
+
+        metrics_port = CONFIG.get('metrics_port', None)
+        if metrics_port:
+            await metrics.serve(CONFIG.get('metrics_host', '127.0.0.1'),
+                                metrics_port + (CLUSTER or 0))
+
+        self.stats_task = asyncio.create_task(self.save_stats())
+
+    async def on_guild_available(self, guild: discord.Guild) -> None:
+        if guild.id in registered_guilds or guild.id not in catalog.guilds:
+            return
+        register_guild(guild.id)
+        try:
+            # only if its commands changed while we were offline
+            await sync_guild(guild.id)
+        except discord.HTTPException as exc:
+            logger.warning('Failed to sync commands in guild %s: %s',
+                           guild.id, exc)
+
+    async def on_ready(self) -> None:
+        logger.info('Ready as %s in %d guilds on shards %s, '
+                    '%.3fs after startup', self.user, len(self.guilds),
+                    sorted(self.shards), time.perf_counter() - STARTUP)
+
+    async def close(self) -> None:
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        # stop the stats writer first so that it flushes what it has
+        task, self.stats_task = self.stats_task, None
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        if hasattr(self, 'session'):
+            await self.session.close()
+        if self.stats_writer is not None:
+            self.stats_writer.close()
+        await metrics.close()
+        await super().close()
+
+    def count_usage(self, ctx: discord.Interaction) -> bool:
+        """Count one usage in memory. Returns whether it was counted."""
+        if not ctx.command:
+            return False # ignore non-command interactions
+        if not isinstance(ctx.command, app_commands.Command):
+            return False # ...what?
+        if ctx.command.qualified_name in {
+            'hello', 'invite', 'version', 'stats', 'cmd', '-cmd'
+        }:
+            return False # don't record stats for meta-commands
+        command_guild = cmd_guild_id(ctx)
+        if command_guild: # guild-specific command
+            key = (ctx.command.qualified_name, command_guild)
+            self.guild_deltas[key] = self.guild_deltas.get(key, 0) + 1
         else:
-            debug_guild = None
-        await self.tree.sync(guild=debug_guild)
+            key = (ctx.command.qualified_name, ctx.guild_id)
+            self.global_deltas[key] = self.global_deltas.get(key, 0) + 1
+        return True
 
-        asyncio.create_task(self.save_stats())
+    async def flush_stats(self) -> None:
+        """Write all counted usages in a single transaction."""
+        guild_deltas, self.guild_deltas = self.guild_deltas, {}
+        global_deltas, self.global_deltas = self.global_deltas, {}
+        if not guild_deltas and not global_deltas:
+            return
+        with STATS_FLUSH_SECONDS.time():
+            if self.dbw is not None:
+                await statsdb.write_stats(
+                    self.dbw, guild_deltas, global_deltas)
+            else:
+                try:
+                    await self.stats_writer.send(guild_deltas, global_deltas)
+                except OSError as exc:
+                    # try again with the next flush
+                    logger.warning('Failed to send stats to writer: %r', exc)
+                    statsdb.merge_deltas(self.guild_deltas, guild_deltas)
+                    statsdb.merge_deltas(self.global_deltas, global_deltas)
+                    return
+        self.stats_cache.clear()
 
     async def save_stats(self) -> None:
-        dbw = await aiosqlite.connect(STATS_FILE)
-        dbw.row_factory = aiosqlite.Row
-        self.db = await dbw.cursor()
-        await self.db.executescript("""
-CREATE TABLE IF NOT EXISTS global_stats (
-    cmd_name TEXT NOT NULL,
-    used_in_guild_id INTEGER NOT NULL,
-    usage_count INTEGER DEFAULT 1,
-    PRIMARY KEY(cmd_name, used_in_guild_id)
-);
-CREATE INDEX IF NOT EXISTS global_cmds ON global_stats(cmd_name);
-CREATE INDEX IF NOT EXISTS global_guilds ON global_stats(used_in_guild_id);
-CREATE TABLE IF NOT EXISTS guild_stats (
-    cmd_name TEXT NOT NULL,
-    guild_id INTEGER NOT NULL,
-    usage_count INTEGER DEFAULT 1,
-    PRIMARY KEY(cmd_name, guild_id)
-);
-CREATE INDEX IF NOT EXISTS guild_guilds ON guild_stats(guild_id);
-""")
+        if self.stats_writer is None: # else the launcher writes
+            self.dbw = await statsdb.connect(STATS_FILE, STATS_PRAGMAS)
+            await statsdb.create_tables(self.dbw)
+        self.readers = await statsdb.ReaderPool.open(
+            STATS_FILE, STATS_PRAGMAS, CONFIG.get('stats_readers', 2))
+        # flush after this many usages, or this many seconds after the
+        # first unflushed usage, whichever comes first
+        threshold: int = CONFIG['commit_threshold']
+        interval: float = CONFIG.get('stats_flush_interval', 5.0)
         try:
             logged_count = 0
+            deadline: Optional[float] = None
             while 1:
-                ctx = await self.log_queue.get()
-                if not ctx.command:
-                    continue # ignore non-command interactions
-                if not isinstance(ctx.command, app_commands.Command):
-                    continue # ...what?
-                if ctx.command.qualified_name in {
-                    'hello', 'invite', 'version', 'stats', 'cmd', '-cmd'
-                }:
-                    continue # don't record stats for meta-commands
-                command_guild = cmd_guild_id(ctx)
-                if command_guild: # guild-specific command
-                    await self.db.execute(
-                        'INSERT INTO guild_stats(cmd_name, guild_id) '
-                        'VALUES (?, ?) ON CONFLICT(cmd_name, guild_id) '
-                        'DO UPDATE SET usage_count = usage_count + 1;',
-                        (ctx.command.qualified_name, command_guild))
+                timeout = None if deadline is None \
+                    else max(0.0, deadline - self.loop.time())
+                try:
+                    ctx = await asyncio.wait_for(self.log_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    pass # time limit hit, flush below
                 else:
-                    await self.db.execute(
-                        'INSERT INTO global_stats(cmd_name, used_in_guild_id) '
-                        'VALUES (?, ?) ON CONFLICT(cmd_name, used_in_guild_id) '
-                        'DO UPDATE SET usage_count = usage_count + 1;',
-                        (ctx.command.qualified_name, ctx.guild_id))
-                logged_count += 1
-                if logged_count >= CONFIG['commit_threshold']:
+                    logged_count += self.count_usage(ctx)
+                    # take everything else that's already waiting too
+                    while not self.log_queue.empty() \
+                            and logged_count < threshold:
+                        logged_count += self.count_usage(
+                            self.log_queue.get_nowait())
+                    if logged_count and deadline is None:
+                        deadline = self.loop.time() + interval
+                if logged_count and (
+                    logged_count >= threshold
+                    or self.loop.time() >= (deadline or 0)
+                ):
                     logger.debug('Logged %s usages, committing stats',
                                  logged_count)
-                    await dbw.commit()
+                    await self.flush_stats()
                     logged_count = 0
+                    deadline = None
         except KeyboardInterrupt:
             logger.info('Goodbye.')
         finally:
-            await dbw.commit()
-            await dbw.close()
-            await self.close()
+            await self.flush_stats()
+            await self.readers.close()
+            if self.dbw is not None:
+                await self.dbw.close()
+            if self.stats_task is not None: # not already closing
+                await self.close()
 
 client = ButtonBot()
 
@@ -220,7 +457,34 @@ def mask(data: str, reveal_last_n: int = 0) -> str:
     command="If specified, only get stats for this command.")
 async def stats(ctx: discord.Interaction, command: Optional[str] = None):
     """Get stats for command usage."""
+    key = (command, ctx.guild_id)
+    cached = client.stats_cache.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        await ctx.response.send_message(embeds=cached[1])
+        return
     await ctx.response.defer()
+    embeds = await stats_embeds(ctx, command)
+    if len(client.stats_cache) >= 1024:
+        # prune stale results so typos don't pile up between flushes
+        now = time.monotonic()
+        for old_key, (expiry, _) in list(client.stats_cache.items()):
+            if expiry <= now:
+                del client.stats_cache[old_key]
+    client.stats_cache[key] = (
+        time.monotonic() + CONFIG.get('stats_cache_ttl', 30.0), embeds)
+    await ctx.edit_original_response(embeds=embeds)
+
+@stats.autocomplete('command')
+async def stats_complete(ctx: discord.Interaction,
+                         current: str) -> List[app_commands.Choice[str]]:
+    prefix = current.casefold()
+    names = sorted(set(catalog.complete(None, prefix))
+                   | set(catalog.complete(ctx.guild_id, prefix)))[:25]
+    return [app_commands.Choice(name=f'/{name}', value=name) for name in names]
+
+async def stats_embeds(ctx: discord.Interaction,
+                       command: Optional[str]) -> List[discord.Embed]:
+    """Render the /stats embeds."""
     if ctx.guild is not None:
         guild_name = discord.utils.escape_markdown(ctx.guild.name)
     else:
@@ -231,8 +495,8 @@ async def stats(ctx: discord.Interaction, command: Optional[str] = None):
         query = 'SELECT used_in_guild_id, usage_count '\
             'FROM global_stats WHERE cmd_name=?'
         guild_data: dict[int, int] = {
-            row[0]: row[1] async for row in
-            await client.db.execute(query, (command,))}
+            row[0]: row[1] for row in
+            await client.readers.fetchall(query, (command,))}
         if guild_data:
             def reveal_if_us(guild_id: int) -> str:
                 if ctx.guild is not None and guild_id == ctx.guild.id:
@@ -249,12 +513,12 @@ async def stats(ctx: discord.Interaction, command: Optional[str] = None):
         if ctx.guild is not None:
             query = 'SELECT usage_count FROM guild_stats ' \
                 'WHERE cmd_name=? AND guild_id=?'
-            await client.db.execute(query, (command, ctx.guild.id))
-            row = await client.db.fetchone()
-            if row:
+            rows = await client.readers.fetchall(
+                query, (command, ctx.guild.id))
+            if rows:
                 embeds.append(discord.Embed(
                     title=f'Stats for `/{command}` in {guild_name}',
-                    description=f'{row[0]} uses',
+                    description=f'{rows[0][0]} uses',
                     color=discord.Color.blue()))
         if not embeds:
             embeds.append(discord.Embed(
@@ -263,10 +527,10 @@ async def stats(ctx: discord.Interaction, command: Optional[str] = None):
                 color=discord.Color.red()))
     else:
         # global stats
-        query = 'SELECT cmd_name, SUM(usage_count) ' \
-            'FROM global_stats GROUP BY cmd_name ORDER BY SUM(usage_count) DESC'
+        query = 'SELECT cmd_name, usage_count ' \
+            'FROM global_totals ORDER BY usage_count DESC'
         cmd_data: dict[str, int] = {
-            row[0]: row[1] async for row in await client.db.execute(query)}
+            row[0]: row[1] for row in await client.readers.fetchall(query)}
         lines = [f'`/{command}`: {count} uses'
                  for command, count in cmd_data.items()]
         embeds.append(discord.Embed(
@@ -275,12 +539,13 @@ async def stats(ctx: discord.Interaction, command: Optional[str] = None):
             color=discord.Color.yellow()))
         # guild stats
         if ctx.guild is not None:
-            query = 'SELECT cmd_name, SUM(usage_count) ' \
+            # (cmd_name, guild_id) is the key, so no aggregation needed
+            query = 'SELECT cmd_name, usage_count ' \
                 'FROM guild_stats WHERE guild_id=? '\
-                'GROUP BY cmd_name ORDER BY SUM(usage_count) DESC'
+                'ORDER BY usage_count DESC'
             cmd_data: dict[str, int] = {
-                row[0]: row[1] async for row in
-                await client.db.execute(query, (ctx.guild.id,))}
+                row[0]: row[1] for row in
+                await client.readers.fetchall(query, (ctx.guild.id,))}
             if cmd_data:
                 lines = [f'`/{command}`: {count} uses'
                         for command, count in cmd_data.items()]
@@ -288,76 +553,767 @@ async def stats(ctx: discord.Interaction, command: Optional[str] = None):
                     title=f'{guild_name} command stats',
                     description='\n'.join(lines),
                     color=discord.Color.blue()))
-    await ctx.edit_original_response(embeds=embeds)
+    return embeds
 
 ### DYNAMIC COMMANDS TECH ###
 
-guild_locks: Dict[int, asyncio.Lock] = {}
-
 def guild_root(guild_id: Optional[int]) -> Path:
     if guild_id:
         return Path('sounds') / '.guild' / str(guild_id)
     return Path('sounds')
 
+BLOB_ROOT = Path('sounds') / '.blobs'
+
+class SoundMeta(NamedTuple):
+    """Metadata of one sound, as stored in its sound.json."""
+    text: str
+    name: str
+    root: Path
+    # hash of the source the audio was converted from (or of the audio,
+    # for streamed links), if it's in BLOB_ROOT
+    blob: Optional[str] = None
+    # measured after conversion; None for sounds not (re)processed yet
+    duration: Optional[float] = None # seconds
+    peak: Optional[float] = None # dBFS
+
+    @property
+    def audio_root(self) -> Path:
+        return self.root if self.blob is None else BLOB_ROOT / self.blob
+
+    @property
+    def mp3(self) -> Path:
+        return self.audio_root / 'sound.mp3'
+
+    @property
+    def opus(self) -> Path:
+        return self.audio_root / 'sound.opus'
+
+    @classmethod
+    def from_json(cls, root: Path, data: dict) -> SoundMeta:
+        return cls(data['text'], data['name'], root, data.get('blob'),
+                   data.get('duration'), data.get('peak'))
+
+    def to_json(self) -> dict:
+        data = {'text': self.text, 'name': self.name}
+        for key in ('blob', 'duration', 'peak'):
+            if getattr(self, key) is not None:
+                data[key] = getattr(self, key)
+        return data
+
+    def save(self) -> None:
+        with open(self.root / 'sound.json', 'w') as f:
+            json.dump(self.to_json(), f)
+
+class SoundCatalog:
+    """In-memory index of sound metadata, keyed by (guild_id, name).
+
+    Everything is read from disk once by :meth:`scan_all` and thereafter
+    kept up to date in place, so playing a sound never touches sound.json.
+    The names in each guild are also kept sorted, for :meth:`complete`.
+    """
+
+    def __init__(self) -> None:
+        self.guilds: Dict[Optional[int], Dict[str, SoundMeta]] = {}
+        self.sorted: Dict[Optional[int], List[str]] = {}
+
+    def __len__(self) -> int:
+        return sum(map(len, self.guilds.values()))
+
+    def get(self, guild_id: Optional[int], name: str) -> SoundMeta:
+        return self.guilds[guild_id][name]
+
+    def find(self, guild_id: Optional[int], name: str) -> Optional[SoundMeta]:
+        return self.guilds.get(guild_id, {}).get(name)
+
+    def set(self, guild_id: Optional[int], name: str, meta: SoundMeta) -> None:
+        sounds = self.guilds.setdefault(guild_id, {})
+        if name not in sounds:
+            insort(self.sorted.setdefault(guild_id, []), name)
+        sounds[name] = meta
+
+    def remove(self, guild_id: Optional[int], name: str) -> Optional[SoundMeta]:
+        meta = self.guilds.get(guild_id, {}).pop(name, None)
+        if meta is not None:
+            names = self.sorted[guild_id]
+            del names[bisect_left(names, name)]
+        return meta
+
+    def replace(self, guild_id: Optional[int],
+                sounds: Dict[str, SoundMeta]) -> None:
+        self.guilds[guild_id] = sounds
+        self.sorted[guild_id] = sorted(sounds)
+
+    def names(self, guild_id: Optional[int]) -> List[str]:
+        """Get the sorted names of every sound in the guild (or global)."""
+        return list(self.sorted.get(guild_id, ()))
+
+    def complete(self, guild_id: Optional[int], prefix: str,
+                 limit: int = 25) -> List[str]:
+        """Get the first few sorted names in the guild starting with prefix."""
+        names = self.sorted.get(guild_id, [])
+        start = bisect_left(names, prefix)
+        return [name for name in islice(names, start, start + limit)
+                if name.startswith(prefix)]
+
+    def read(self, guild_id: Optional[int], name: str) -> SoundMeta:
+        """(Re-)read one sound's metadata from disk into the catalog."""
+        root = guild_root(guild_id) / name
+        with open(root / 'sound.json') as f:
+            meta = SoundMeta.from_json(root, json.load(f))
+        self.set(guild_id, name, meta)
+        return meta
+
+    def scan_all(self, guild_ids: List[Optional[int]], workers: int) -> None:
+        """Scan many guilds at once, reading their directories in threads."""
+        with ThreadPoolExecutor(workers) as pool:
+            for guild_id, sounds in zip(
+                    guild_ids, pool.map(self.read_guild, guild_ids)):
+                self.replace(guild_id, sounds)
+
+    @staticmethod
+    def read_guild(guild_id: Optional[int]) -> Dict[str, SoundMeta]:
+        """Read the metadata of every sound in the guild from disk."""
+        root = guild_root(guild_id)
+        sounds: Dict[str, SoundMeta] = {}
+        for name in os.listdir(root):
+            if not NAME_REGEX.match(name):
+                continue
+            try:
+                os.rmdir(root / name)
+            except OSError:
+                pass # not empty, can probably be used
+            else:
+                continue # was empty, skip
+            try:
+                with open(root / name / 'sound.json') as f:
+                    sounds[name] = SoundMeta.from_json(
+                        root / name, json.load(f))
+            except FileNotFoundError:
+                continue # left over from a failed /cmd, or being added
+        return sounds
+
+catalog = SoundCatalog()
+
+# Sounds added by /cmd are stored once per unique source, by its hash,
+# in BLOB_ROOT/<hash>/, and their sound.json points at that. Streamed
+# links are only read as far as ffmpeg needs, so are named by the hash of
+# the converted audio instead.
+# Blobs are shared by every process (see launcher.py), so what is still
+# in use is judged by the sound.json files on disk, not the catalog.
+
+# blobs stored or reused this recently are never collected, since a /cmd
+# in another process may be about to point a sound at them
+BLOB_GRACE_PERIOD: float = CONFIG.get('blob_grace_period', 3600.0)
+
+def file_digest(*fns: Path) -> str:
+    """Hash files, one after another, the way blobs are named."""
+    hasher = hashlib.sha256()
+    for fn in fns:
+        with open(fn, 'rb') as f:
+            while chunk := f.read(1024*1024):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+def has_blob(digest: str) -> bool:
+    blob = BLOB_ROOT / digest
+    return (blob / 'sound.mp3').exists() and (blob / 'sound.opus').exists()
+
+def store_blob(root: Path, digest: str) -> None:
+    """Move sound files freshly converted in root into the blob store."""
+    blob = BLOB_ROOT / digest
+    os.makedirs(blob, exist_ok=True)
+    for fn in ('sound.mp3', 'sound.opus'):
+        if (blob / fn).exists():
+            os.remove(root / fn) # someone else converted it first
+        else:
+            os.replace(root / fn, blob / fn)
+    os.utime(blob) # see BLOB_GRACE_PERIOD
+
+# digest -> /cmds about to point a sound at the blob, which mustn't be
+# collected before they have
+pending_blobs: Counter[str] = Counter()
+
+def blobs_on_disk() -> Optional[Set[str]]:
+    """Get the blobs that the sound.json of any sound points at.
+
+    Returns None if some sound.json couldn't be read, e.g. because it is
+    being written, in which case it's not safe to collect anything.
+    """
+    blobs: Set[str] = set()
+    for guild_id in [None, *guild_ids_on_disk()]:
+        root = guild_root(guild_id)
+        for name in os.listdir(root):
+            if not NAME_REGEX.match(name):
+                continue
+            try:
+                with open(root / name / 'sound.json') as f:
+                    blob = json.load(f).get('blob')
+            except FileNotFoundError:
+                continue # being added or removed, pending_blobs has it
+            except (OSError, ValueError) as exc:
+                logger.warning('Not collecting blobs, failed to read %s: %r',
+                               root / name / 'sound.json', exc)
+                return None
+            if blob is not None:
+                blobs.add(blob)
+    return blobs
+
+def collect_blobs(referenced: Set[str]) -> int:
+    """Delete blobs no sound points at anymore. Returns how many."""
+    referenced = referenced | pending_blobs.keys()
+    try:
+        digests = os.listdir(BLOB_ROOT)
+    except FileNotFoundError:
+        return 0
+    fresh = time.time() - BLOB_GRACE_PERIOD
+    count = 0
+    for digest in digests:
+        if digest in referenced:
+            continue
+        blob = BLOB_ROOT / digest
+        try:
+            if os.stat(blob).st_mtime > fresh:
+                continue
+        except FileNotFoundError:
+            continue # someone else collected it
+        opus_cache.invalidate(blob / 'sound.opus')
+        upload_cache.drop_file(blob / 'sound.mp3')
+        shutil.rmtree(blob, True)
+        logger.debug('Deleted unused blob %s', digest)
+        count += 1
+    return count
+
+async def collect_unused_blobs() -> None:
+    """Delete blobs no sound on disk points at anymore."""
+    referenced = await asyncio.to_thread(blobs_on_disk)
+    if referenced is not None:
+        collect_blobs(referenced)
+
 def sound(name: str, guild_id: Optional[int]) -> Tuple[str, Path]:
     """Get the (message text, sound filename) from sound name."""
-    root = guild_root(guild_id)
-    with open(root / name / 'sound.json') as f:
-        text = json.load(f)['text']
-    return text, root / name / 'sound.mp3'
-
-def sound_source(name: str, guild_id: Optional[int]) \
-        -> Tuple[str, discord.FFmpegOpusAudio]:
-    """Get the FFmpegOpusAudio source from sound name."""
-    text, fn = sound(name, guild_id)
-    fn = str(fn).rsplit('.', 1)[0] + '.opus'
-    return text, discord.FFmpegOpusAudio(fn, codec='copy')
-
-async def wait_and_unset(vc: discord.VoiceClient):
-    """Wait a few seconds before leaving."""
-    await asyncio.sleep(LEAVE_DELAY)
-    if vc is not None and not vc.is_playing():
-        # - not already left
-        # - not playing audio anymore
-        await vc.disconnect() # so leave
+    meta = catalog.get(guild_id, name)
+    return meta.text, meta.mp3
 
-async def play_in_voice(
-    ctx: discord.Interaction, name: str,
-    channel: Union[discord.VoiceChannel, discord.StageChannel],
-    guild: Optional[discord.abc.Snowflake]
-) -> None:
-    """Play the sound in a voice channel."""
-    if ctx.guild is None or not isinstance(ctx.command, app_commands.Command):
-        logger.warning('play_in_voice called from outside guild or command? '
-                       'guild: %r, command: %r', ctx.guild, ctx.command)
-        return
-    lock = guild_locks.setdefault(ctx.guild.id, asyncio.Lock())
-    async with lock:
-        text, source = sound_source(name, guild.id if guild else None)
-        asyncio.create_task(ctx.edit_original_response(content=text))
-        # if things error past here, we've already sent the message
+opus_cache = OpusCache(CONFIG.get('opus_cache_bytes', 32 * 1024 * 1024))
+
+async def sound_source(name: str, guild_id: Optional[int]) \
+        -> Tuple[str, OpusPacketSource]:
+    """Get the cached Opus packet source from sound name."""
+    meta = catalog.get(guild_id, name)
+    return meta.text, await opus_cache.source(meta.opus)
+
+class UploadCache:
+    """Remembers chat-mode uploads so repeat clicks needn't re-upload.
+
+    After a sound is first uploaded in a guild, the attachment's CDN URL
+    is kept (until shortly before Discord expires it) and later clicks in
+    that guild just link to it. Each guild gets its own upload, since the
+    URL names the channel it was posted in.
+
+    Whenever the sound does have to be uploaded (the first time in each
+    guild, or every time with ``reuse_upload_urls`` off), its mp3 bytes
+    come from a byte-bounded LRU cache, so that at least the file needn't
+    be read from disk again.
+    """
+
+    def __init__(self, max_bytes: int, reuse_urls: bool) -> None:
+        self.max_bytes = max_bytes
+        self.reuse_urls = reuse_urls
+        # (guild_id used in, sound guild_id, name) -> (CDN URL, unix expiry)
+        self.urls: Dict[Tuple[Optional[int], Optional[int], str],
+                        Tuple[str, float]] = {}
+        self.prune_at = 1024 # forget expired URLs once there are this many
+        self.data: OrderedDict[Path, bytes] = OrderedDict()
+        self.size = 0
+
+    def url(self, used_in: Optional[int], guild_id: Optional[int],
+            name: str) -> Optional[str]:
+        """Get the URL of a previous upload of the sound in the guild
+        it's used in, if still valid."""
+        key = (used_in, guild_id, name)
+        entry = self.urls.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.time():
+            del self.urls[key]
+            return None
+        return entry[0]
+
+    def remember(self, used_in: Optional[int], guild_id: Optional[int],
+                 name: str, message: discord.Message) -> None:
+        """Remember the URL of the sound as uploaded in the message."""
+        if not self.reuse_urls or not message.attachments:
+            return
+        url = message.attachments[0].url
+        # signed CDN URLs carry their expiry as hex seconds in ?ex=
+        expiry = time.time() + 12 * 60 * 60
+        ex = parse_qs(urlparse(url).query).get('ex')
+        if ex:
+            try:
+                expiry = min(expiry, int(ex[0], 16) - 60)
+            except ValueError:
+                pass # weird URL, the default is good enough
+        self.urls[used_in, guild_id, name] = (url, expiry)
+        if len(self.urls) >= self.prune_at:
+            now = time.time()
+            self.urls = {key: entry for key, entry in self.urls.items()
+                         if entry[1] > now}
+            self.prune_at = max(1024, 2 * len(self.urls))
+
+    async def file(self, fn: Path, filename: str) -> discord.File:
+        """Get an uploadable file of the sound, from memory if possible."""
+        data = self.data.get(fn)
+        if data is not None:
+            self.data.move_to_end(fn)
+        else:
+            data = await asyncio.to_thread(fn.read_bytes)
+            if len(data) <= self.max_bytes:
+                self.data[fn] = data
+                self.size += len(data)
+                while self.size > self.max_bytes:
+                    _, old = self.data.popitem(last=False)
+                    self.size -= len(old)
+        return discord.File(io.BytesIO(data), filename=filename)
+
+    def invalidate(self, guild_id: Optional[int], name: str, fn: Path) -> None:
+        """Forget everything about a sound that changed or was removed."""
+        for key in [key for key in self.urls if key[1:] == (guild_id, name)]:
+            del self.urls[key]
+        self.drop_file(fn)
+
+    def drop_file(self, fn: Path) -> None:
+        data = self.data.pop(fn, None)
+        if data is not None:
+            self.size -= len(data)
+
+upload_cache = UploadCache(CONFIG.get('upload_cache_bytes', 32 * 1024 * 1024),
+                           CONFIG.get('reuse_upload_urls', True))
+
+class VoicePool:
+    """Keeps voice connections warm between plays.
+
+    A connection is left open for ``idle_timeout`` seconds after its last
+    play, so repeated clicks skip the voice handshake. At most
+    ``max_connections`` are kept; the least recently used one is dropped
+    to make room for a new one.
+    """
+
+    def __init__(self, idle_timeout: float, max_connections: int) -> None:
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        # guild_id -> voice client, least recently used first
+        self.clients: OrderedDict[int, discord.VoiceClient] = OrderedDict()
+        self.in_use: Dict[int, int] = {}
+        self.timers: Dict[int, asyncio.TimerHandle] = {}
+        # guild_id -> connection started by preconnect() but not yet done
+        self.connecting: Dict[int, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self.clients)
+
+    def preconnect(
+        self, channel: Union[discord.VoiceChannel, discord.StageChannel]
+    ) -> None:
+        """Start connecting (or moving) to the channel in the background,
+        so that a following :meth:`acquire` has less (or nothing) to wait for.
+
+        Only for guilds where nothing is playing, since it may move the
+        connection; otherwise :meth:`acquire` moves it once it's done.
+        """
+        guild_id = channel.guild.id
+        vc: Optional[discord.VoiceClient] \
+            = channel.guild.voice_client # type: ignore # not customized
+        if guild_id in self.connecting or (
+            vc is not None and vc.is_connected() and vc.channel.id == channel.id
+        ):
+            return # already there or getting there
+        self.hold(guild_id)
+        task = asyncio.create_task(self.connect(channel))
+        self.connecting[guild_id] = task
+        def done(task: asyncio.Task) -> None:
+            self.connecting.pop(guild_id, None)
+            self.release(guild_id)
+            if not task.cancelled() and task.exception() is not None:
+                # acquire() will try again and report it
+                logger.debug('Failed to preconnect in guild %s: %r',
+                             guild_id, task.exception())
+        task.add_done_callback(done)
+
+    async def acquire(
+        self, channel: Union[discord.VoiceChannel, discord.StageChannel]
+    ) -> discord.VoiceClient:
+        """Get a connection to the channel, reusing the guild's if any."""
+        guild_id = channel.guild.id
+        self.hold(guild_id)
+        try:
+            with VOICE_CONNECT_SECONDS.time():
+                pending = self.connecting.get(guild_id)
+                if pending is not None:
+                    await asyncio.wait([pending])
+                return await self.connect(channel)
+        except BaseException:
+            self.release(guild_id)
+            raise
+
+    def hold(self, guild_id: int) -> None:
+        """Mark a play as started, so the connection isn't left idle."""
+        timer = self.timers.pop(guild_id, None)
+        if timer is not None:
+            timer.cancel()
+        self.in_use[guild_id] = self.in_use.get(guild_id, 0) + 1
+
+    async def connect(
+        self, channel: Union[discord.VoiceChannel, discord.StageChannel]
+    ) -> discord.VoiceClient:
         vc: Optional[discord.VoiceClient] \
-            = ctx.guild.voice_client # type: ignore # not customized
+            = channel.guild.voice_client # type: ignore # not customized
+        if vc is not None and not vc.is_connected():
+            await vc.disconnect(force=True) # stale, start over
+            vc = None
+        if vc is not None and vc.channel.id != channel.id:
+            # finished playing in another channel, move to author's channel
+            await vc.move_to(channel)
+        elif vc is None:
+            # haven't been playing, join author's channel
+            await self.make_room()
+            vc = await channel.connect(timeout=5)
+        self.clients[channel.guild.id] = vc
+        self.clients.move_to_end(channel.guild.id)
+        return vc
+
+    def release(self, guild_id: int) -> None:
+        """Mark a play as finished, starting the idle timer if it was the last."""
+        count = self.in_use.pop(guild_id, 1) - 1
+        if count > 0:
+            self.in_use[guild_id] = count
+            return
+        if guild_id in self.clients:
+            self.timers[guild_id] = client.loop.call_later(
+                self.idle_timeout,
+                lambda: asyncio.create_task(self.expire(guild_id)))
+
+    async def make_room(self) -> None:
+        """Disconnect least recently used connections until one is free."""
+        for guild_id in list(self.clients):
+            if len(self.clients) < self.max_connections:
+                return
+            if guild_id in self.in_use:
+                continue # prefer idle connections
+            await self.drop(guild_id)
+        while len(self.clients) >= self.max_connections:
+            await self.drop(next(iter(self.clients)))
+
+    async def expire(self, guild_id: int) -> None:
+        self.timers.pop(guild_id, None)
+        if guild_id not in self.in_use:
+            logger.debug('Voice connection in guild %s idle, leaving', guild_id)
+            await self.drop(guild_id)
+
+    async def drop(self, guild_id: int) -> None:
+        timer = self.timers.pop(guild_id, None)
+        if timer is not None:
+            timer.cancel()
+        vc = self.clients.pop(guild_id, None)
+        if vc is not None:
+            await vc.disconnect()
+
+voice_pool = VoicePool(CONFIG.get('voice_idle_timeout', 60.0),
+                       CONFIG.get('max_voice_connections', 100))
+
+class PlayItem(NamedTuple):
+    """A sound waiting to be played in a guild."""
+    name: str
+    guild_id: Optional[int] # guild the sound belongs to, None if global
+    channel: Union[discord.VoiceChannel, discord.StageChannel]
+    # stage -> perf_counter() time it was done, starting from 'start'
+    timings: Dict[str, float]
+
+    def mark(self, stage: str) -> None:
+        self.timings[stage] = time.perf_counter()
+
+    def report(self) -> None:
+        start = self.timings['start']
+        FIRST_PACKET_SECONDS.observe(self.timings['first_packet'] - start)
+        logger.debug('Played /%s in guild %s: %s', self.name,
+                     self.channel.guild.id, ', '.join(
+                         f'{stage} {when - start:.3f}s' for stage, when
+                         in self.timings.items() if stage != 'start'))
+
+def timed_frames(frames: Iterator[bytes],
+                 on_first_read: Callable[[], None]) -> Iterator[bytes]:
+    """Wrap a mixer voice to find out when its first frame is read."""
+    for frame in frames:
+        on_first_read()
+        yield frame
+        break
+    yield from frames
+
+class TimedSource(discord.AudioSource):
+    """Wraps an audio source to find out when its first packet is read."""
+
+    def __init__(self, source: discord.AudioSource,
+                 on_first_read: Callable[[], None]) -> None:
+        self.source = source
+        self.on_first_read: Optional[Callable[[], None]] = on_first_read
+
+    def read(self) -> bytes:
+        data = self.source.read()
+        if self.on_first_read is not None:
+            self.on_first_read()
+            self.on_first_read = None
+        return data
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self) -> None:
+        self.source.cleanup()
+
+class GuildPlayer:
+    """Plays a guild's queued sounds one after another.
+
+    What happens to a sound submitted while another is playing depends on
+    ``playback_policy``:
+
+    - ``queue``: play it after everything before it
+    - ``dedupe``: like ``queue``, but drop it if the same sound was
+      submitted less than ``playback_dedupe_window`` seconds ago
+    - ``interrupt``: stop the current sound and drop the queue to play it
+    - ``mix``: play it over the current sound if that is in the same
+      channel, up to ``max_mixed_voices`` sounds at once
+
+    No more than ``playback_queue_depth`` sounds wait at once;
+    further ones are rejected.
+    """
+
+    POLICIES = {'queue', 'dedupe', 'interrupt', 'mix'}
+
+    def __init__(self, guild_id: int) -> None:
+        self.guild_id = guild_id
+        self.queue: Deque[PlayItem] = deque()
+        self.task: Optional[asyncio.Task] = None
+        self.vc: Optional[discord.VoiceClient] = None
+        self.mixer: Optional[MixerSource] = None
+        # resolves once the current play is over
+        self.done: Optional[asyncio.Task] = None
+        # (sound guild_id, name) -> loop time last submitted
+        self.recent: Dict[Tuple[Optional[int], str], float] = {}
+        # drops this player from guild_players once idle
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def idle(self) -> bool:
+        return not self.queue and self.vc is None \
+            and (self.task is None or self.task.done())
+
+    def check_idle(self) -> None:
+        """Forget this player once it has been idle for a while.
+
+        Not before ``playback_dedupe_window`` has passed, though, so that
+        the last sounds played still count as recent.
+        """
+        if self.queue or self.vc is not None:
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = client.loop.call_later(
+            PLAYBACK_DEDUPE_WINDOW, self.expire)
+
+    def expire(self) -> None:
+        self.timer = None
+        if self.idle() and guild_players.get(self.guild_id) is self:
+            del guild_players[self.guild_id]
+
+    def rejects(self, guild_id: Optional[int], name: str) -> Optional[str]:
+        """Get the reason the sound would be rejected now, if it would."""
+        if PLAYBACK_POLICY == 'dedupe':
+            last = self.recent.get((guild_id, name))
+            if last is not None \
+                    and client.loop.time() - last < PLAYBACK_DEDUPE_WINDOW:
+                return f'`/{name}` was just played, not playing it again.'
+        if PLAYBACK_POLICY != 'interrupt' \
+                and len(self.queue) >= PLAYBACK_QUEUE_DEPTH:
+            return 'Too many sounds are waiting to be played, try again later.'
+        return None
+
+    def submit(self, item: PlayItem) -> Optional[str]:
+        """Queue the sound. Returns the reason if it was rejected."""
+        now = client.loop.time()
+        key = (item.guild_id, item.name)
+        error = self.rejects(item.guild_id, item.name)
+        if error is not None:
+            return error
+        if PLAYBACK_POLICY == 'interrupt':
+            self.queue.clear()
+            if self.vc is not None:
+                self.vc.stop() # ends the current play, moving on to this
+        self.queue.append(item)
+        if self.timer is not None: # no longer idle
+            self.timer.cancel()
+            self.timer = None
+        if len(self.recent) >= 64:
+            self.recent = {k: t for k, t in self.recent.items()
+                           if now - t < PLAYBACK_DEDUPE_WINDOW}
+        self.recent[key] = now
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return None
+
+    async def run(self) -> None:
+        while self.queue:
+            item = self.queue.popleft()
+            try:
+                await self.play(item)
+            except (discord.HTTPException, discord.ClientException,
+                    asyncio.TimeoutError, KeyError) as exc:
+                # we did our best
+                logger.warning('Failed to play /%s in guild %s: %r',
+                               item.name, self.guild_id, exc)
+            except Exception:
+                logger.exception('Failed to play /%s in guild %s:',
+                                 item.name, self.guild_id)
+        self.check_idle()
+
+    async def play(self, item: PlayItem) -> None:
+        _, source = await sound_source(item.name, item.guild_id)
+        item.mark('source')
+        def first_read() -> None: # called in the player thread
+            item.mark('first_packet')
+            client.loop.call_soon_threadsafe(item.report)
+        if self.mixer is not None and self.vc is not None \
+                and self.vc.channel.id == item.channel.id \
+                and self.mixer.add(timed_frames(pcm_frames(source.packets),
+                                                first_read)):
+            return # layered over what's already playing in that channel
+        if self.done is not None and not self.done.done():
+            # let the previous play's player thread finish
+            await asyncio.wait([self.done])
+        vc = await voice_pool.acquire(item.channel)
+        item.mark('connect')
         try:
-            if vc is not None and vc.channel.id != channel.id:
-                # finished playing in another channel, move to author's channel
-                await vc.move_to(channel)
-            elif vc is None:
-                # haven't been playing, join author's channel
-                vc = await channel.connect(timeout=5)
+            if PLAYBACK_POLICY == 'mix':
+                self.mixer = MixerSource(MAX_MIXED_VOICES)
+                self.mixer.add(pcm_frames(source.packets))
+                source = TimedSource(self.mixer, first_read)
+            else:
+                source = TimedSource(source, first_read)
             # convert callback-based to awaiting
             fut: asyncio.Future = client.loop.create_future()
             def after(exc):
                 if exc:
-                    fut.set_exception(exc)
+                    client.loop.call_soon_threadsafe(fut.set_exception, exc)
                 else:
-                    fut.set_result(None)
+                    client.loop.call_soon_threadsafe(fut.set_result, None)
+            self.vc = vc
             vc.play(source, after=after)
+        except BaseException:
+            self.vc = self.mixer = None
+            voice_pool.release(self.guild_id)
+            raise
+        self.done = asyncio.create_task(self.finish(fut))
+        if self.mixer is None:
+            await asyncio.wait([self.done])
+
+    async def finish(self, fut: asyncio.Future) -> None:
+        try:
             await fut
+        except Exception:
+            logger.exception('Error while playing in guild %s:', self.guild_id)
         finally:
-            # finished playing (hopefully)
-            if vc is not None:
-                asyncio.create_task(wait_and_unset(vc))
+            # finished playing (hopefully), leave once idle for a while
+            self.vc = self.mixer = None
+            voice_pool.release(self.guild_id)
+            self.check_idle()
+
+PLAYBACK_POLICY: str = CONFIG.get('playback_policy', 'queue')
+PLAYBACK_QUEUE_DEPTH: int = CONFIG.get('playback_queue_depth', 5)
+PLAYBACK_DEDUPE_WINDOW: float = CONFIG.get('playback_dedupe_window', 2.0)
+MAX_MIXED_VOICES: int = CONFIG.get('max_mixed_voices', 4)
+if PLAYBACK_POLICY not in GuildPlayer.POLICIES:
+    raise ValueError(f'Invalid playback_policy {PLAYBACK_POLICY!r}, '
+                     f'must be one of {sorted(GuildPlayer.POLICIES)}')
+
+guild_players: Dict[int, GuildPlayer] = {}
+
+metrics.gauge('log_queue_depth', 'Interactions waiting to be counted.',
+              lambda: client.log_queue.qsize())
+metrics.gauge('voice_clients', 'Connected voice clients.',
+              lambda: len(client.voice_clients))
+metrics.gauge('pooled_voice_connections', 'Voice connections kept warm.',
+              lambda: len(voice_pool))
+metrics.gauge('guild_players', 'Guilds with a playback queue.',
+              lambda: len(guild_players))
+metrics.gauge('opus_cache_bytes', 'Size of cached Opus packets.',
+              lambda: opus_cache.size)
+metrics.counter('opus_cache_hits_total', 'Opus cache hits.',
+                lambda: opus_cache.hits)
+metrics.counter('opus_cache_misses_total', 'Opus cache misses.',
+                lambda: opus_cache.misses)
+metrics.counter('opus_cache_evictions_total', 'Opus cache evictions.',
+                lambda: opus_cache.evictions)
+
+def resident_memory() -> int:
+    """Get the resident set size of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError: # not Linux, settle for the peak
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def memory_report() -> Dict[str, int]:
+    """Measure everything held in memory that grows with traffic."""
+    return {
+        'resident_bytes': resident_memory(),
+        'sounds': len(catalog),
+        'registered_guilds': len(registered_guilds),
+        'guild_players': len(guild_players),
+        'recent_plays': sum(len(player.recent)
+                            for player in guild_players.values()),
+        'pooled_voice_connections': len(voice_pool),
+        'opus_cache_bytes': opus_cache.size,
+        'upload_cache_urls': len(upload_cache.urls),
+        'upload_cache_bytes': upload_cache.size,
+        'stats_cache_entries': len(client.stats_cache),
+        'rate_limit_buckets': len(USER_CLICKS or ()) + len(GUILD_CLICKS or ()),
+        'unflushed_stats': len(client.guild_deltas)
+        + len(client.global_deltas),
+    }
+
+metrics.counter('rate_limited_total', 'Sound commands rejected for '
+                'exceeding a rate limit.', lambda: client.tree.rate_limited)
+metrics.gauge('rate_limit_buckets', 'Users and guilds being rate limited.',
+              lambda: len(USER_CLICKS or ()) + len(GUILD_CLICKS or ()))
+metrics.counter('log_records_dropped_total', 'Log records dropped because '
+                'the log writer fell behind.', lambda: log_queue_handler.dropped)
+metrics.gauge('log_records_queued', 'Log records waiting to be written.',
+              lambda: log_queue_handler.queue.qsize())
+metrics.gauge('resident_memory_bytes', 'Resident memory of the process.',
+              resident_memory)
+metrics.gauge('upload_cache_urls', 'Chat uploads remembered for reuse.',
+              lambda: len(upload_cache.urls))
+metrics.gauge('stats_cache_entries', 'Cached /stats results.',
+              lambda: len(client.stats_cache))
+
+async def play_in_voice(
+    ctx: discord.Interaction, name: str,
+    channel: Union[discord.VoiceChannel, discord.StageChannel],
+    guild: Optional[discord.abc.Snowflake], timings: Dict[str, float]
+) -> None:
+    """Queue the sound to play in a voice channel."""
+    if ctx.guild is None or not isinstance(ctx.command, app_commands.Command):
+        logger.warning('play_in_voice called from outside guild or command? '
+                       'guild: %r, command: %r', ctx.guild, ctx.command)
+        return
+    player = guild_players.get(ctx.guild.id)
+    if player is None:
+        player = guild_players[ctx.guild.id] = GuildPlayer(ctx.guild.id)
+    text, _ = sound(name, guild.id if guild else None)
+    error = player.submit(PlayItem(
+        name, guild.id if guild else None, channel, timings))
+    if error is not None:
+        await send_error(ctx.edit_original_response, error)
+    else:
+        # respond as soon as it's queued, not once it's played
+        await ctx.edit_original_response(content=text)
 
 async def execute(ctx: discord.Interaction, chat: bool, name: str,
                   guild: Optional[discord.abc.Snowflake]) -> None:
@@ -366,18 +1322,36 @@ async def execute(ctx: discord.Interaction, chat: bool, name: str,
         and isinstance(ctx.command, app_commands.Command)
     if ctx.user.voice is not None and ctx.user.voice.channel \
             is not None and not chat:
+        timings = {'start': time.perf_counter()}
+        # connecting is the slowest part, so start it first, unless
+        # something is playing that moving the connection would cut off
+        player = guild_players.get(ctx.guild_id) # type: ignore
+        if player is None or (player.idle() and player.rejects(
+                guild.id if guild else None, name) is None):
+            voice_pool.preconnect(ctx.user.voice.channel)
         await ctx.response.defer(ephemeral=True)
+        timings['defer'] = time.perf_counter()
         try:
-            await play_in_voice(ctx, name, ctx.user.voice.channel, guild)
+            await play_in_voice(ctx, name, ctx.user.voice.channel, guild,
+                                timings)
         except (discord.HTTPException, asyncio.TimeoutError):
             return # we did our best
         else:
             return # success, stop here
     else:
         await ctx.response.defer()
-        text, fn = sound(name, guild.id if guild else None)
-        f = discord.File(fn, filename=name + '.mp3')
-        await ctx.edit_original_response(content=text, attachments=[f])
+        guild_id = guild.id if guild else None
+        text, fn = sound(name, guild_id)
+        url = upload_cache.url(ctx.guild_id, guild_id, name)
+        if url is not None:
+            # already uploaded, just link to that
+            await ctx.edit_original_response(content=f'{text}\n{url}')
+            return
+        f = await upload_cache.file(fn, name + '.mp3')
+        with CHAT_UPLOAD_SECONDS.time():
+            msg = await ctx.edit_original_response(
+                content=text, attachments=[f])
+        upload_cache.remember(ctx.guild_id, guild_id, name, msg)
 
 def make_cmd(name: str, desc: str,
              guild: Optional[discord.abc.Snowflake]) -> None:
@@ -388,36 +1362,419 @@ def make_cmd(name: str, desc: str,
     @app_commands.guild_only
     async def __cmd(ctx: discord.Interaction, chat: bool = False):
         """Closure for /(name)"""
-        await execute(ctx, chat, name, guild)
+        with COMMAND_SECONDS.time():
+            await execute(ctx, chat, name, guild)
+
+def register_cmd(guild_id: Optional[int], name: str) -> None:
+    """(Re-)register one sound's command from the sound catalog."""
+    guild = discord.Object(guild_id) if guild_id else None
+    client.tree.remove_command(name, guild=guild)
+    desc = f"Play a {catalog.get(guild_id, name).name} sound effect."
+    logger.info('Adding /%s in guild %s: %r', name, guild_id, desc)
+    make_cmd(name, desc, guild)
+
+def unregister_cmd(guild_id: Optional[int], name: str) -> None:
+    guild = discord.Object(guild_id) if guild_id else None
+    if client.tree.remove_command(name, guild=guild) is not None:
+        logger.info('Removed /%s in guild %s', name, guild_id)
 
-def load_guild(guild_id: Optional[int]):
+registered_guilds: Set[Optional[int]] = set()
+
+def register_guild(guild_id: Optional[int]) -> None:
+    """(Re-)register the guild's commands from the sound catalog."""
+    registered_guilds.add(guild_id)
     if guild_id:
         guild = discord.Object(guild_id)
         client.tree.clear_commands(guild=guild)
+        if guild_id == CONFIG.get('guild_id', None):
+            client.tree.copy_global_to(guild=guild) # debug guild
+    for name in catalog.names(guild_id):
+        register_cmd(guild_id, name)
+
+try:
+    with open(SYNC_FILE) as f:
+        # str(guild_id) or 'global' -> hash of the commands last synced
+        sync_hashes: Dict[str, str] = json.load(f)
+except FileNotFoundError:
+    sync_hashes = {}
+
+def commands_hash(guild_id: Optional[int]) -> str:
+    """Hash the guild's commands as they would be sent to Discord."""
+    guild = discord.Object(guild_id) if guild_id else None
+    payload = sorted((cmd.to_dict(client.tree) for cmd
+                      in client.tree.get_commands(guild=guild)),
+                     key=lambda data: data['name'])
+    return hashlib.sha256(json.dumps(
+        payload, sort_keys=True, default=str).encode()).hexdigest()
+
+async def sync_guild(guild_id: Optional[int]) -> bool:
+    """Sync the guild's commands if they changed since the last sync.
+
+    Returns whether a sync was actually done.
+    """
+    key = str(guild_id) if guild_id else 'global'
+    digest = commands_hash(guild_id)
+    if sync_hashes.get(key) == digest:
+        logger.debug('Commands in guild %s unchanged, not syncing', guild_id)
+        return False
+    with TREE_SYNC_SECONDS.time():
+        await client.tree.sync(
+            guild=discord.Object(guild_id) if guild_id else None)
+    sync_hashes[key] = digest
+    with open(SYNC_FILE, 'w') as f:
+        json.dump(sync_hashes, f)
+    return True
+
+# Sounds edited on disk while running are reloaded by the watcher.
+
+def changed_sounds(path: Path) -> Set[Tuple[Optional[int], str]]:
+    """Get the sounds a change to path (relative to sounds/) may affect."""
+    parts = path.parts
+    if not parts: # anything
+        return {key for guild_id in [None, *guild_ids_on_disk()]
+                for key in guild_sounds(guild_id)}
+    if parts[0] == '.guild':
+        if len(parts) == 1:
+            return {key for guild_id in guild_ids_on_disk()
+                    for key in guild_sounds(guild_id)}
+        if not parts[1].isdigit():
+            return set()
+        guild_id = int(parts[1])
+        if len(parts) == 2:
+            return guild_sounds(guild_id)
+        name = parts[2]
     else:
-        guild = None
-    root = guild_root(guild_id)
-    for name in os.listdir(root):
-        if not NAME_REGEX.match(name):
+        guild_id, name = None, parts[0]
+    return {(guild_id, name)} if NAME_REGEX.match(name) else set()
+
+def guild_sounds(guild_id: Optional[int]) -> Set[Tuple[Optional[int], str]]:
+    """Get every sound in the guild, whether on disk or in the catalog."""
+    try:
+        names = set(os.listdir(guild_root(guild_id)))
+    except FileNotFoundError:
+        names = set()
+    names.update(catalog.names(guild_id))
+    return {(guild_id, name) for name in names if NAME_REGEX.match(name)}
+
+def guild_ids_on_disk() -> List[int]:
+    return [int(sid) for sid in os.listdir(Path('sounds') / '.guild')
+            if sid.isdigit()]
+
+def reload_sound(guild_id: Optional[int], name: str) -> bool:
+    """Bring a sound's catalog entry and command up to date with the disk.
+
+    Returns whether its command changed.
+    """
+    old = catalog.find(guild_id, name)
+    try:
+        meta: Optional[SoundMeta] = catalog.read(guild_id, name)
+    except FileNotFoundError:
+        meta = None
+    except (OSError, ValueError, KeyError) as exc:
+        # probably still being written; the next change retries it
+        logger.warning('Not reloading /%s in guild %s: %r',
+                       name, guild_id, exc)
+        return False
+    if old is not None: # its audio may have changed even if this didn't
+        opus_cache.invalidate(old.opus)
+        upload_cache.invalidate(guild_id, name, old.mp3)
+    if meta is None:
+        if old is None:
+            return False
+        # unused blobs are collected by the next /cmd, /-cmd or restart,
+        # since one may be about to be used by a /cmd in progress
+        catalog.remove(guild_id, name)
+        unregister_cmd(guild_id, name)
+        return True
+    if old is not None and old.name == meta.name:
+        return False # same description, nothing to sync
+    if guild_id is None or guild_id in registered_guilds:
+        register_cmd(guild_id, name)
+    return True
+
+async def reload_sounds(paths: Set[Path]) -> None:
+    """Reload the sounds under the changed paths, syncing what changed."""
+    changed: Set[Optional[int]] = set()
+    for guild_id, name in {key for path in paths
+                           for key in changed_sounds(path)}:
+        if reload_sound(guild_id, name):
+            changed.add(guild_id)
+    debug_guild_id = CONFIG.get('guild_id', None)
+    if None in changed and debug_guild_id:
+        changed.add(debug_guild_id) # has copies of the global commands
+    for guild_id in changed:
+        if guild_id and client.get_guild(guild_id) is None:
+            continue # not ours (yet), registered once available
+        if guild_id and (guild_id not in registered_guilds
+                         or guild_id == debug_guild_id):
+            register_guild(guild_id) # new, or needs global commands again
+        if guild_id is None and (CLUSTER or debug_guild_id):
+            # the first process syncs for everyone; in debug mode, global
+            # commands are only synced to the debug guild
             continue
         try:
-            os.rmdir(root / name)
-        except OSError:
-            pass # not empty, can probably be used
-        else:
-            continue # was empty, skip
-        with open(root / name / 'sound.json') as f:
-            descname = json.load(f)['name']
-        desc = f"Play a {descname} sound effect."
-        logger.info('Adding /%s in guild %s: %r', name, guild_id, desc)
-        make_cmd(name, desc, guild)
+            await sync_guild(guild_id)
+        except discord.HTTPException as exc:
+            logger.warning('Failed to sync commands in guild %s: %s',
+                           guild_id, exc)
+    if changed:
+        logger.info('Reloaded changed sounds in %s',
+                    ', '.join(f'guild {guild_id}' if guild_id else 'global'
+                              for guild_id in changed))
 
 ### DYNAMIC COMMANDS TECH END ###
 
-def cleanup_failure(fn: Path, root: Path):
+async def reprocess(audio_root: Path) -> Tuple[Optional[float], Optional[float]]:
+    """Trim and normalize existing sound files in place, like /cmd does."""
+    new_mp3 = audio_root / 'new.mp3'
+    new_opus = audio_root / 'new.opus'
+    try:
+        returncode, stdout = await transcoder.run(convert_cmd(
+            audio_root / 'sound.mp3', new_mp3, new_opus))
+        if returncode != 0:
+            raise RuntimeError(f'ffmpeg failed:\n{stdout}')
+        os.replace(new_mp3, audio_root / 'sound.mp3')
+        os.replace(new_opus, audio_root / 'sound.opus')
+    finally:
+        for fn in (new_mp3, new_opus):
+            try:
+                os.remove(fn)
+            except FileNotFoundError:
+                pass
+    return parse_measurements(stdout)
+
+async def reprocess_all() -> None:
+    """Reprocess every sound that hasn't been measured yet."""
+    todo: Dict[Path, List[Tuple[Optional[int], SoundMeta]]] = {}
+    for guild_id, sounds in catalog.guilds.items():
+        for meta in sounds.values():
+            if meta.duration is None:
+                todo.setdefault(meta.audio_root, []).append((guild_id, meta))
+    logger.info('Reprocessing %d sound files', len(todo))
+    results = await asyncio.gather(
+        *map(reprocess, todo), return_exceptions=True)
+    for (audio_root, metas), result in zip(todo.items(), results):
+        if isinstance(result, BaseException):
+            logger.error('Failed to reprocess %s: %s', audio_root, result)
+            continue
+        duration, peak = result
+        for guild_id, meta in metas:
+            meta = meta._replace(duration=duration, peak=peak)
+            meta.save()
+            catalog.set(guild_id, meta.root.name, meta)
+            logger.info('Reprocessed %s: %ss, peak %s dBFS',
+                        meta.root, duration, peak)
+
+class TranscodeScheduler:
+    """Runs transcoding subprocesses, no more than ``workers`` at a time.
+
+    Jobs wait their turn in FIFO order, and a job that runs longer than
+    ``timeout`` seconds is killed.
+    """
+
+    def __init__(self, workers: int, timeout: float) -> None:
+        self.workers = workers
+        self.timeout = timeout
+        self.running = 0
+        self.waiting: Deque[object] = deque()
+        self.cond = asyncio.Condition()
+        # metrics
+        self.jobs = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {
+            'queued': len(self.waiting),
+            'running': self.running,
+            'jobs': self.jobs,
+            'timeouts': self.timeouts,
+            'avg_wait': self.total_wait / self.jobs if self.jobs else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+    async def acquire(self, progress: Optional[Callable[[int], None]]) -> None:
+        """Wait for a free worker, calling ``progress`` with the position
+        in the queue whenever it changes."""
+        ticket = object()
+        start = time.perf_counter()
+        async with self.cond:
+            self.waiting.append(ticket)
+            try:
+                last_position = 0
+                while self.waiting[0] is not ticket \
+                        or self.running >= self.workers:
+                    position = self.waiting.index(ticket) + 1
+                    if progress is not None and position != last_position:
+                        progress(position)
+                    last_position = position
+                    await self.cond.wait()
+            finally:
+                self.waiting.remove(ticket)
+                self.cond.notify_all() # everyone behind moved up
+            self.running += 1
+        waited = time.perf_counter() - start
+        self.jobs += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        logger.debug('Transcode job waited %.3fs: %r', waited, self.stats())
+
+    async def release(self) -> None:
+        async with self.cond:
+            self.running -= 1
+            self.cond.notify_all()
+
+    async def run(self, cmd: List[Union[str, Path]],
+                  progress: Optional[Callable[[int], None]] = None,
+                  feed: Optional[Callable[[asyncio.StreamWriter],
+                                          Awaitable[None]]] = None) \
+            -> Tuple[Optional[int], str]:
+        """Run the command when a worker is free.
+
+        If ``feed`` is given, it is called to write the command's stdin
+        while the command runs; any error it raises kills the command and
+        is propagated.
+
+        Returns its (return code, combined stdout and stderr); raises
+        :exc:`asyncio.TimeoutError` if it had to be killed.
+        """
+        await self.acquire(progress)
+        try:
+            with TRANSCODE_SECONDS.time():
+                return await self.execute(cmd, feed)
+        finally:
+            await self.release()
+
+    async def execute(self, cmd: List[Union[str, Path]],
+                      feed: Optional[Callable[[asyncio.StreamWriter],
+                                              Awaitable[None]]]) \
+            -> Tuple[Optional[int], str]:
+        logger.debug('Executing: %s', cmd)
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=None if feed is None else asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT)
+        try:
+            if feed is None:
+                stdout, _ = await asyncio.wait_for(
+                    proc.communicate(), self.timeout)
+            else:
+                assert proc.stdin is not None and proc.stdout is not None
+                stdout, _ = await asyncio.wait_for(asyncio.gather(
+                    proc.stdout.read(), self.pump(proc.stdin, feed)
+                ), self.timeout)
+                await proc.wait()
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.warning('Killing %s after %ss', cmd[0], self.timeout)
+            proc.kill()
+            await proc.wait()
+            raise
+        except BaseException:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+        return proc.returncode, stdout.decode()
+
+    @staticmethod
+    async def pump(stdin: asyncio.StreamWriter,
+                   feed: Callable[[asyncio.StreamWriter], Awaitable[None]]
+                   ) -> None:
+        try:
+            await feed(stdin)
+        except (BrokenPipeError, ConnectionResetError):
+            pass # stopped reading, e.g. because it had enough
+        finally:
+            stdin.close()
+
+transcoder = TranscodeScheduler(
+    CONFIG.get('transcode_workers', os.cpu_count() or 1),
+    CONFIG.get('transcode_timeout', 120.0))
+
+metrics.gauge('transcode_queue_depth', 'Transcode jobs waiting to run.',
+              lambda: len(transcoder.waiting))
+metrics.gauge('transcode_running', 'Transcode jobs running.',
+              lambda: transcoder.running)
+
+MAX_DOWNLOAD_BYTES: int = CONFIG.get('max_download_bytes', 100 * 1024 * 1024)
+MAX_SOUND_DURATION: float = CONFIG.get('max_sound_duration', 120.0)
+# containers that ffmpeg may need to seek in, so can't be piped in
+UNSTREAMABLE_FORMATS = {'mp4', 'm4a', 'm4v', 'mov', '3gp', '3g2', 'mj2'}
+
+# trim silence from the start, then (by reversing) the end,
+# then normalize loudness (EBU R128), back to 48kHz since loudnorm
+# upsamples, and measure the peak of the result
+AUDIO_FILTERS = ','.join([
+    'silenceremove=start_periods=1:start_threshold={0}dB:start_silence=0.05',
+    'areverse',
+    'silenceremove=start_periods=1:start_threshold={0}dB:start_silence=0.05',
+    'areverse',
+    'loudnorm=I={1}:TP=-1.5:LRA=11',
+    'aresample=48000',
+    'volumedetect',
+]).format(CONFIG.get('silence_threshold', -50),
+          CONFIG.get('loudness_target', -16))
+
+def convert_cmd(src: Union[str, Path], mp3: Path,
+                opus: Path) -> List[Union[str, Path]]:
+    """Get the ffmpeg command that converts a source into the sound files."""
+    # -t before -i stops reading input once it's long enough;
+    # the filters run once, their output split between both files
+    return ['ffmpeg', '-t', str(MAX_SOUND_DURATION), '-i', src,
+            '-filter_complex', f'[0:a]{AUDIO_FILTERS},asplit=2[mp3][opus]',
+            '-map', '[mp3]', mp3, '-map', '[opus]', opus]
+
+def parse_measurements(output: str) -> Tuple[Optional[float], Optional[float]]:
+    """Get the (duration in seconds, peak in dBFS) of what ffmpeg wrote,
+    from its output, if it ran volumedetect."""
+    duration = peak = None
+    # the last progress report is of the whole output
+    times = re.findall(r'time=(\d+):(\d+):(\d+(?:\.\d+)?)', output)
+    if times:
+        hours, minutes, seconds = times[-1]
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    match = re.search(r'max_volume: (-?\d+(?:\.\d+)?) dB', output)
+    if match:
+        peak = float(match.group(1))
+    return duration, peak
+
+async def measure(fn: Path) -> Tuple[Optional[float], Optional[float]]:
+    """Get the (duration in seconds, peak in dBFS) of a sound file."""
+    try:
+        returncode, stdout = await transcoder.run([
+            'ffmpeg', '-hide_banner', '-i', fn,
+            '-af', 'volumedetect', '-f', 'null', '-'])
+    except asyncio.TimeoutError:
+        logger.warning('Timed out measuring %s', fn)
+        return None, None
+    if returncode != 0:
+        logger.warning('Failed to measure %s:\n%s', fn, output_tail(stdout))
+        return None, None
+    return parse_measurements(stdout)
+
+def output_tail(output: str) -> str:
+    """Cut a subprocess's output down to its end, where errors would be."""
+    chars: int = CONFIG.get('log_output_chars', 2000)
+    if len(output) <= chars:
+        return output
+    return '[...]' + output[-chars:]
+
+def queue_progress(ctx: discord.Interaction) -> Callable[[int], None]:
+    """Show the interaction's position in the transcode queue."""
+    def progress(position: int) -> None:
+        asyncio.create_task(ctx.edit_original_response(
+            content=f'Waiting for other sounds to be converted first: '
+            f'#{position} in queue'))
+    return progress
+
+def cleanup_failure(fn: Optional[Path], root: Path):
     # remove the tmp file if it exists
     try:
-        os.remove(fn)
+        if fn is not None:
+            os.remove(fn)
     except FileNotFoundError:
         pass
     # remove the command directory if it's empty
@@ -447,29 +1804,70 @@ async def try_save_file(ctx: discord.Interaction, root: Path,
         return None
     return fn
 
+class DownloadTooLarge(Exception):
+    """The linked file is bigger than ``max_download_bytes``."""
+
+def url_extension(link: str) -> str:
+    """Get the file extension of the link; IndexError if it has none."""
+    urlpath = urlparse(link.strip()).path # includes leading slash
+    return urlpath.rsplit('/', 1)[1].rsplit('.', 1)[1]
+
+async def download(link: str,
+                   write: Callable[[bytes], Awaitable[None]]) -> None:
+    """Download the link chunk by chunk, up to ``max_download_bytes``."""
+    async with client.session.get(link.strip()) as response:
+        response.raise_for_status()
+        if (response.content_length or 0) > MAX_DOWNLOAD_BYTES:
+            raise DownloadTooLarge(
+                f'Larger than {MAX_DOWNLOAD_BYTES} bytes')
+        CHUNK = 1024*1024
+        size = 0
+        while chunk := await response.content.read(CHUNK):
+            size += len(chunk)
+            if size > MAX_DOWNLOAD_BYTES:
+                raise DownloadTooLarge(
+                    f'Larger than {MAX_DOWNLOAD_BYTES} bytes')
+            await write(chunk)
+
+def stream_url(link: str) -> Callable[[asyncio.StreamWriter], Awaitable[None]]:
+    """Get a transcoder feed that pipes the link's download into stdin.
+
+    The download stops as soon as the command stops reading, as ffmpeg
+    does once it has ``-t`` seconds of audio.
+    """
+    async def feed(stdin: asyncio.StreamWriter) -> None:
+        async def write(chunk: bytes) -> None:
+            if stdin.is_closing(): # exited without a write failing yet
+                raise BrokenPipeError
+            stdin.write(chunk)
+            await stdin.drain()
+        logger.debug('Streaming link %s to transcoder', link)
+        await download(link, write)
+    return feed
+
 async def try_save_url(ctx: discord.Interaction,
                        root: Path, link: str) -> Optional[Path]:
     try:
-        urlpath = urlparse(link.strip()).path # includes leading slash
-        fn = 'tmp.' + urlpath.rsplit('/', 1)[1].rsplit('.', 1)[1]
-        fn = root / fn
+        fn = root / ('tmp.' + url_extension(link))
         logger.debug('Saving filename link %s to %s', link, fn)
     except IndexError:
         logger.debug('Link invalid as filename, trying youtube-dl: %s', link)
         raise # indicates to retry as youtube-dl url
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(link.strip()) as response:
-                response.raise_for_status()
-                CHUNK = 1024*1024
-                with open(fn, 'wb') as f:
-                    while chunk := await response.content.read(CHUNK):
-                        f.write(chunk)
+        with open(fn, 'wb') as f:
+            async def write(chunk: bytes) -> None:
+                f.write(chunk)
+            await download(link, write)
     except aiohttp.InvalidURL:
         await send_error(ctx.edit_original_response,
                          'Failed to download link: Invalid URL')
         return None
-    except aiohttp.ClientError as exc:
+    except asyncio.TimeoutError:
+        await send_error(ctx.edit_original_response,
+                         'Failed to download link: Took too long')
+        cleanup_failure(fn, root)
+        return None
+    except (aiohttp.ClientError, DownloadTooLarge) as exc:
         logger.exception('Failed to download %s:', link)
         await send_error(ctx.edit_original_response,
                          f'Failed to download link: {exc!s}')
@@ -492,20 +1890,20 @@ async def try_save_ytd(ctx: discord.Interaction,
             # output file is deleted after -x
             '-o', str(fn).replace('.m4a', '.%(ext)s'),
         ]
-        logger.debug('Executing: %s', cmd)
-        proc = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT)
-        stdout, _ = await proc.communicate()
-        stdout = stdout.decode()
-        logger.debug('youtube-dl subprocess exited; output:\n%s', stdout)
-        if proc.returncode != 0:
+        returncode, stdout = await transcoder.run(cmd, queue_progress(ctx))
+        logger.debug('youtube-dl subprocess exited; output:\n%s',
+                     output_tail(stdout))
+        if returncode != 0:
             await send_error(ctx.edit_original_response,
                              'Failed to download link:\n'
                              f'```\n{stdout}\n```')
             cleanup_failure(fn, root)
             return None
+    except asyncio.TimeoutError:
+        await send_error(ctx.edit_original_response,
+                         'Failed to download link: Took too long')
+        cleanup_failure(fn, root)
+        return None
     except Exception as exc:
         logger.exception('Failed to youtube-dl link:')
         await send_error(ctx.edit_original_response,
@@ -514,6 +1912,61 @@ async def try_save_ytd(ctx: discord.Interaction,
         return None
     return fn
 
+def remove_sound_files(root: Path) -> None:
+    try:
+        os.remove(root / 'sound.mp3')
+    except FileNotFoundError:
+        pass
+    try:
+        os.remove(root / 'sound.opus')
+    except FileNotFoundError:
+        pass
+
+async def try_convert(
+    ctx: discord.Interaction, root: Path, fn: Optional[Path],
+    feed: Optional[Callable[[asyncio.StreamWriter], Awaitable[None]]],
+    link: Optional[str]
+) -> Optional[Tuple[Optional[float], Optional[float]]]:
+    """Convert the saved file (or fed stdin) to root/sound.{mp3,opus}.
+
+    Returns the (duration, peak) of the result, or None if it failed.
+    """
+    MP3 = root / 'sound.mp3'
+    OPUS = root / 'sound.opus'
+    remove_sound_files(root)
+    converted = False
+    try:
+        cmd = convert_cmd('pipe:0' if fn is None else fn, MP3, OPUS)
+        returncode, stdout = await transcoder.run(
+            cmd, queue_progress(ctx), feed)
+        logger.debug('ffmpeg subprocess exited; output:\n%s',
+                     output_tail(stdout))
+        if returncode != 0:
+            stdout = stdout.rsplit('  lib', 1)[1].split('\n', 1)[1]
+            await send_error(ctx.edit_original_response,
+                             'Failed to convert audio:\n'
+                             f'```\n{stdout}\n```')
+            return None
+        converted = True
+    except asyncio.TimeoutError:
+        await send_error(ctx.edit_original_response,
+                         'Failed to convert audio: Took too long')
+        return None
+    except aiohttp.InvalidURL:
+        await send_error(ctx.edit_original_response,
+                         'Failed to download link: Invalid URL')
+        return None
+    except (aiohttp.ClientError, DownloadTooLarge) as exc:
+        logger.exception('Failed to download %s:', link)
+        await send_error(ctx.edit_original_response,
+                         f'Failed to download link: {exc!s}')
+        return None
+    finally:
+        if not converted:
+            # partly written once ffmpeg opened them
+            remove_sound_files(root)
+    return parse_measurements(stdout)
+
 async def create_cmd(ctx: discord.Interaction, name: str,
                      text: str, description: str,
                      file: Optional[discord.Attachment] = None,
@@ -524,52 +1977,78 @@ async def create_cmd(ctx: discord.Interaction, name: str,
     text = text
     root = guild_root(ctx.guild.id) / name
     os.makedirs(root, exist_ok=True)
+    fn: Optional[Path]
+    feed: Optional[Callable[[asyncio.StreamWriter], Awaitable[None]]] = None
     if file is not None:
         fn = await try_save_file(ctx, root, file)
         if fn is None:
             return # error already reported
+        logger.debug('Saved argument to %s', fn)
     elif link is not None:
         try:
-            fn = await try_save_url(ctx, root, link)
+            ext = url_extension(link)
         except IndexError: # link without file extension, maybe ytd-able?
+            logger.debug('Link invalid as filename, trying youtube-dl: %s',
+                         link)
             fn = await try_save_ytd(ctx, root, link)
-        if fn is None:
+        else:
+            if ext.casefold() in UNSTREAMABLE_FORMATS:
+                fn = await try_save_url(ctx, root, link)
+            else:
+                # no need to save it first, pipe the download into ffmpeg
+                fn, feed = None, stream_url(link)
+        if fn is None and feed is None:
             return # error already reported
+        logger.debug('Saved argument to %s', fn or 'stdin')
     else:
         raise RuntimeError('Logical impossibility')
-    logger.debug('Saved argument to %s', fn)
-    MP3 = root / 'sound.mp3'
-    OPUS = root / 'sound.opus'
-    try:
-        os.remove(MP3)
-    except FileNotFoundError:
-        pass
-    try:
-        os.remove(OPUS)
-    except FileNotFoundError:
-        pass
+    digest: Optional[str] = None
+    measured: Optional[Tuple[Optional[float], Optional[float]]] = None
     try:
-        cmd = ['ffmpeg', '-i', fn, MP3, OPUS]
-        logger.debug('Executing: %s', cmd)
-        proc = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT)
-        stdout, _ = await proc.communicate()
-        stdout = stdout.decode()
-        logger.debug('ffmpeg subprocess exited; output:\n%s', stdout)
-        if proc.returncode != 0:
-            stdout = stdout.rsplit('  lib', 1)[1].split('\n', 1)[1]
-            await send_error(ctx.edit_original_response,
-                             'Failed to convert audio:\n'
-                             f'```\n{stdout}\n```')
-            return
+        if fn is not None:
+            digest = await asyncio.to_thread(file_digest, fn)
+            pending_blobs[digest] += 1
+        if digest is not None and has_blob(digest):
+            # same source as an existing sound, reuse its conversion
+            logger.debug('Reusing blob %s for %s', digest, fn)
+            os.utime(BLOB_ROOT / digest) # see BLOB_GRACE_PERIOD
+            remove_sound_files(root) # from before it was a blob, if any
+        else:
+            measured = await try_convert(ctx, root, fn, feed, link)
+            if measured is None:
+                return # error already reported
+            if digest is None: # streamed, so hash what it became
+                digest = await asyncio.to_thread(
+                    file_digest, root / 'sound.mp3', root / 'sound.opus')
+                pending_blobs[digest] += 1
+            store_blob(root, digest)
+        meta = SoundMeta(text, description, root, digest)
+        if measured is None: # reused, so measured with another sound
+            same = next((other for sounds in catalog.guilds.values()
+                         for other in sounds.values() if other.blob == digest
+                         and other.duration is not None), None)
+            if same is not None:
+                measured = same.duration, same.peak
+            else: # in another process, or left over; rare
+                measured = await measure(meta.opus)
+        meta = meta._replace(duration=measured[0], peak=measured[1])
+        # written before cleaning up so that root isn't removed as empty
+        meta.save()
+        old = catalog.find(ctx.guild.id, name)
+        catalog.set(ctx.guild.id, name, meta)
     finally:
         cleanup_failure(fn, root)
-    with open(root / 'sound.json', 'w') as f:
-        json.dump({'text': text, 'name': description}, f)
-    load_guild(ctx.guild.id)
-    await client.tree.sync(guild=ctx.guild)
+        if digest is not None: # referenced by the catalog now, if at all
+            pending_blobs[digest] -= 1
+            if not pending_blobs[digest]:
+                del pending_blobs[digest]
+    upload_cache.invalidate(ctx.guild.id, name, meta.mp3)
+    if old is not None and old.blob != digest:
+        opus_cache.invalidate(old.opus)
+        upload_cache.drop_file(old.mp3)
+        await collect_unused_blobs()
+    register_cmd(ctx.guild.id, name)
+    await sync_guild(ctx.guild.id)
     await ctx.edit_original_response(content=f'Successfully added/modified `/{name}`')
 
 class CommandTextModal(discord.ui.Modal):
@@ -635,10 +2114,23 @@ async def del_cmd(ctx: discord.Interaction, name: str):
     await ctx.response.defer(ephemeral=True)
     root = guild_root(ctx.guild.id) / name
     shutil.rmtree(root, True)
-    load_guild(ctx.guild.id)
-    await client.tree.sync(guild=ctx.guild)
+    old = catalog.remove(ctx.guild.id, name)
+    if old is not None:
+        opus_cache.invalidate(old.opus)
+        upload_cache.invalidate(ctx.guild.id, name, old.mp3)
+        await collect_unused_blobs()
+    unregister_cmd(ctx.guild.id, name)
+    await sync_guild(ctx.guild.id)
     await ctx.edit_original_response(content=f'Removed `/{name}` if it exists')
 
+@del_cmd.autocomplete('name')
+async def del_cmd_complete(ctx: discord.Interaction,
+                           current: str) -> List[app_commands.Choice[str]]:
+    if ctx.guild_id is None:
+        return []
+    return [app_commands.Choice(name=f'/{name}', value=name) for name
+            in catalog.complete(ctx.guild_id, current.casefold())]
+
 async def cmd_check(ctx: discord.Interaction) -> bool:
     assert isinstance(ctx.user, discord.Member)
     if not ctx.user.guild_permissions.manage_guild:
@@ -663,9 +2155,18 @@ cmd.add_check(cmd_check)
 del_cmd.add_check(cmd_check)
 del_cmd.add_check(del_check)
 
-load_guild(None)
-for sid in os.listdir(Path('sounds') / '.guild'):
-    if not sid.isdigit():
-        continue
-    load_guild(int(sid))
-client.run(CONFIG['token'], log_handler=None)
+scan_start = time.perf_counter()
+catalog.scan_all([None] + guild_ids_on_disk(),
+                 CONFIG.get('startup_workers', 16))
+# just read from disk, no need to again
+collect_blobs({meta.blob for sounds in catalog.guilds.values()
+               for meta in sounds.values() if meta.blob is not None})
+# guild commands are registered once the guild becomes available
+register_guild(None)
+logger.info('Loaded %d sounds in %d guilds in %.3fs', len(catalog),
+            len(catalog.guilds) - 1, time.perf_counter() - scan_start)
+if __name__ == '__main__':
+    if '--reprocess' in sys.argv:
+        asyncio.run(reprocess_all())
+    else:
+        client.run(CONFIG['token'], log_handler=None)
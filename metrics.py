@@ -0,0 +1,121 @@
+"""Minimal Prometheus-style metrics, served over HTTP by aiohttp."""
+from __future__ import annotations
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Union
+import logging
+import time
+from aiohttp import web
+
+logger = logging.getLogger('ButtonBot.metrics')
+
+# seconds, from "instant" to "Discord gave up on us"
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    """Counts observations into cumulative buckets."""
+
+    def __init__(self, name: str, help: str,
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # last is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        """Observe how long the ``with`` block takes."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} histogram']
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {total}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+class Gauge:
+    """A value read from a function whenever metrics are collected.
+
+    With ``type='counter'``, the function must only ever go up.
+    """
+
+    def __init__(self, name: str, help: str,
+                 func: Callable[[], float], type: str = 'gauge') -> None:
+        self.name = name
+        self.help = help
+        self.func = func
+        self.type = type
+
+    def render(self) -> List[str]:
+        try:
+            value = self.func()
+        except Exception: # not available (yet), e.g. before setup_hook
+            return []
+        return [f'# HELP {self.name} {self.help}',
+                f'# TYPE {self.name} {self.type}',
+                f'{self.name} {value}']
+
+class Registry:
+    """All metrics of the bot, and the HTTP endpoint that exposes them."""
+
+    def __init__(self, prefix: str) -> None:
+        self.prefix = prefix
+        self.metrics: Dict[str, Union[Histogram, Gauge]] = {}
+        self.runner: Optional[web.AppRunner] = None
+
+    def histogram(self, name: str, help: str,
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(self.prefix + name, help, buckets)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def gauge(self, name: str, help: str, func: Callable[[], float]) -> Gauge:
+        metric = Gauge(self.prefix + name, help, func)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str,
+                func: Callable[[], float]) -> Gauge:
+        metric = Gauge(self.prefix + name, help, func, 'counter')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(line for metric in self.metrics.values()
+                         for line in metric.render()) + '\n'
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.render(),
+                            content_type='text/plain', charset='utf-8')
+
+    async def serve(self, host: str, port: int) -> None:
+        """Serve /metrics on the running event loop."""
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logger.info('Serving metrics on http://%s:%s/metrics', host, port)
+
+    async def close(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
@@ -0,0 +1,50 @@
+"""Token bucket rate limiting for many keys at once."""
+from __future__ import annotations
+from typing import Dict, Hashable, Tuple
+
+class TokenBuckets:
+    """Token buckets refilling at ``rate`` tokens per second up to ``burst``.
+
+    Only buckets that aren't full are stored, as (tokens, time) pairs; a
+    missing key is a full bucket. Buckets that have since filled up are
+    swept away every ``sweep_interval`` seconds, so memory use follows
+    recent traffic rather than everyone who ever clicked.
+    """
+
+    def __init__(self, rate: float, burst: float,
+                 sweep_interval: float = 60.0) -> None:
+        if rate <= 0 or burst < 1:
+            raise ValueError(f'Invalid rate limit: {rate}/s, burst {burst}')
+        self.rate = rate
+        self.burst = burst
+        self.sweep_interval = sweep_interval
+        self.buckets: Dict[Hashable, Tuple[float, float]] = {}
+        self.next_sweep = 0.0
+
+    def __len__(self) -> int:
+        return len(self.buckets)
+
+    def tokens(self, key: Hashable, now: float) -> float:
+        entry = self.buckets.get(key)
+        if entry is None:
+            return self.burst
+        tokens, then = entry
+        return min(self.burst, tokens + (now - then) * self.rate)
+
+    def retry_after(self, key: Hashable, now: float) -> float:
+        """Get the seconds until a token is available, 0 if one is now."""
+        tokens = self.tokens(key, now)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def take(self, key: Hashable, now: float) -> None:
+        """Take a token, which should be available."""
+        self.buckets[key] = (self.tokens(key, now) - 1, now)
+        if now >= self.next_sweep:
+            self.sweep(now)
+
+    def sweep(self, now: float) -> None:
+        """Forget buckets that are full again."""
+        self.next_sweep = now + self.sweep_interval
+        self.buckets = {
+            key: (tokens, then) for key, (tokens, then) in self.buckets.items()
+            if tokens + (now - then) * self.rate < self.burst}
@@ -0,0 +1,217 @@
+"""The command usage stats database, and a writer shared between processes.
+
+The database is in WAL mode, so that it can be written through one
+connection while /stats reads it through a :class:`ReaderPool` of others
+without either waiting on the other.
+
+When ButtonBot runs as several processes (see launcher.py), only the
+launcher writes to the database: each process sends its batches of
+usage counts to a :class:`StatsWriter` over a local socket with a
+:class:`StatsWriterClient`, and reads the database itself for /stats.
+"""
+from __future__ import annotations
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import asyncio
+import json
+import logging
+import aiosqlite
+
+logger = logging.getLogger('ButtonBot.statsdb')
+
+# (cmd_name, guild_id) -> uses not yet written to the database
+Deltas = Dict[Tuple[str, int], int]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS global_stats (
+    cmd_name TEXT NOT NULL,
+    used_in_guild_id INTEGER NOT NULL,
+    usage_count INTEGER DEFAULT 1,
+    PRIMARY KEY(cmd_name, used_in_guild_id)
+);
+CREATE INDEX IF NOT EXISTS global_cmds ON global_stats(cmd_name);
+CREATE INDEX IF NOT EXISTS global_guilds ON global_stats(used_in_guild_id);
+CREATE TABLE IF NOT EXISTS guild_stats (
+    cmd_name TEXT NOT NULL,
+    guild_id INTEGER NOT NULL,
+    usage_count INTEGER DEFAULT 1,
+    PRIMARY KEY(cmd_name, guild_id)
+);
+CREATE INDEX IF NOT EXISTS guild_guilds ON guild_stats(guild_id);
+CREATE TABLE IF NOT EXISTS global_totals (
+    cmd_name TEXT PRIMARY KEY,
+    usage_count INTEGER DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS global_totals_counts
+    ON global_totals(usage_count);
+-- backfill totals from before the table existed
+INSERT INTO global_totals(cmd_name, usage_count)
+    SELECT cmd_name, SUM(usage_count) FROM global_stats
+    WHERE NOT EXISTS (SELECT 1 FROM global_totals)
+    GROUP BY cmd_name;
+"""
+
+def config_pragmas(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Get the PRAGMAs to open the database with from buttonbot.json."""
+    return {
+        # in WAL mode, NORMAL only risks the last commits if the OS crashes
+        'synchronous': config.get('stats_synchronous', 'NORMAL'),
+        'cache_size': config.get('stats_cache_size', -16000), # negative: KiB
+        'mmap_size': config.get('stats_mmap_size', 64 * 1024 * 1024),
+    }
+
+async def connect(path: str, pragmas: Dict[str, Any],
+                  readonly: bool = False) -> aiosqlite.Connection:
+    """Open the database, setting the given PRAGMAs on the connection."""
+    if readonly:
+        db = await aiosqlite.connect(f'file:{path}?mode=ro', uri=True)
+    else:
+        db = await aiosqlite.connect(path)
+        # persists in the file, so readers get it too
+        await db.execute('PRAGMA journal_mode=WAL;')
+    for name, value in pragmas.items():
+        if not name.isidentifier() or not (
+                isinstance(value, int) or str(value).isidentifier()):
+            raise ValueError(f'Invalid PRAGMA {name}={value!r}')
+        await db.execute(f'PRAGMA {name}={value};')
+    return db
+
+class ReaderPool:
+    """A few read-only connections, used by one query at a time each."""
+
+    def __init__(self, connections: List[aiosqlite.Connection]) -> None:
+        self.connections = connections
+        self.idle: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        for db in connections:
+            self.idle.put_nowait(db)
+
+    @classmethod
+    async def open(cls, path: str, pragmas: Dict[str, Any],
+                   size: int) -> ReaderPool:
+        return cls([await connect(path, pragmas, readonly=True)
+                    for _ in range(max(1, size))])
+
+    async def fetchall(self, query: str,
+                       params: Iterable[Any] = ()) -> List[Tuple[Any, ...]]:
+        db = await self.idle.get()
+        try:
+            return list(await db.execute_fetchall(query, tuple(params)))
+        finally:
+            self.idle.put_nowait(db)
+
+    async def close(self) -> None:
+        for db in self.connections:
+            await db.close()
+
+async def create_tables(db: aiosqlite.Connection) -> None:
+    await db.executescript(SCHEMA)
+    await db.commit()
+
+async def write_stats(db: aiosqlite.Connection, guild_deltas: Deltas,
+                      global_deltas: Deltas) -> None:
+    """Add the usage counts to the database in a single transaction."""
+    await db.executemany(
+        'INSERT INTO guild_stats(cmd_name, guild_id, usage_count) '
+        'VALUES (?, ?, ?) ON CONFLICT(cmd_name, guild_id) '
+        'DO UPDATE SET usage_count = usage_count + excluded.usage_count;',
+        [(cmd_name, guild_id, delta) for (cmd_name, guild_id), delta
+         in guild_deltas.items()])
+    await db.executemany(
+        'INSERT INTO global_stats(cmd_name, used_in_guild_id, usage_count) '
+        'VALUES (?, ?, ?) ON CONFLICT(cmd_name, used_in_guild_id) '
+        'DO UPDATE SET usage_count = usage_count + excluded.usage_count;',
+        [(cmd_name, guild_id, delta) for (cmd_name, guild_id), delta
+         in global_deltas.items()])
+    cmd_deltas: Dict[str, int] = {}
+    for (cmd_name, _), delta in global_deltas.items():
+        cmd_deltas[cmd_name] = cmd_deltas.get(cmd_name, 0) + delta
+    await db.executemany(
+        'INSERT INTO global_totals(cmd_name, usage_count) '
+        'VALUES (?, ?) ON CONFLICT(cmd_name) '
+        'DO UPDATE SET usage_count = usage_count + excluded.usage_count;',
+        list(cmd_deltas.items()))
+    await db.commit()
+
+def merge_deltas(into: Deltas, deltas: Deltas) -> None:
+    for key, delta in deltas.items():
+        into[key] = into.get(key, 0) + delta
+
+# Each batch is sent as one line of JSON, {"guild": [[cmd_name, guild_id,
+# delta], ...], "global": [...]}, and answered with "ok" once committed.
+
+def encode_batch(guild_deltas: Deltas, global_deltas: Deltas) -> bytes:
+    return json.dumps({
+        'guild': [[*key, delta] for key, delta in guild_deltas.items()],
+        'global': [[*key, delta] for key, delta in global_deltas.items()],
+    }).encode() + b'\n'
+
+def decode_batch(line: bytes) -> Tuple[Deltas, Deltas]:
+    data = json.loads(line)
+    return ({(cmd_name, guild_id): delta
+             for cmd_name, guild_id, delta in data['guild']},
+            {(cmd_name, guild_id): delta
+             for cmd_name, guild_id, delta in data['global']})
+
+class StatsWriter:
+    """Writes the batches sent by every process, one at a time."""
+
+    def __init__(self, db: aiosqlite.Connection) -> None:
+        self.db = db
+        self.lock = asyncio.Lock() # one transaction at a time
+        self.batches = 0
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        peer = writer.get_extra_info('peername')
+        try:
+            while line := await reader.readline():
+                try:
+                    guild_deltas, global_deltas = decode_batch(line)
+                except (ValueError, KeyError, TypeError) as exc:
+                    logger.warning('Bad stats batch from %s: %r', peer, exc)
+                    writer.write(b'error\n')
+                    continue
+                async with self.lock:
+                    await write_stats(self.db, guild_deltas, global_deltas)
+                self.batches += 1
+                writer.write(b'ok\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        except Exception:
+            logger.exception('Failed to write stats from %s:', peer)
+        finally:
+            writer.close()
+
+class StatsWriterClient:
+    """Sends batches to a :class:`StatsWriter`, connecting as needed."""
+
+    def __init__(self, host: str, port: int) -> None:
+        self.host = host
+        self.port = port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def send(self, guild_deltas: Deltas, global_deltas: Deltas) -> None:
+        """Send a batch and wait for it to be committed.
+
+        Raises :class:`OSError` if it might not have been.
+        """
+        if self.writer is None or self.writer.is_closing():
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port)
+        assert self.reader is not None
+        try:
+            self.writer.write(encode_batch(guild_deltas, global_deltas))
+            await self.writer.drain()
+            reply = await self.reader.readline()
+        except OSError:
+            self.close()
+            raise
+        if reply != b'ok\n':
+            self.close()
+            raise ConnectionError(f'stats writer replied {reply!r}')
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
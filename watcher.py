@@ -0,0 +1,206 @@
+"""Watch a directory tree for changes, with inotify or else by polling."""
+from __future__ import annotations
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import sys
+
+logger = logging.getLogger('ButtonBot.watcher')
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE \
+    | IN_DELETE | IN_DELETE_SELF
+EVENT = struct.Struct('iIII') # wd, mask, cookie, len; then the name
+
+class TreeWatcher:
+    """Calls back with the paths that changed under ``root``.
+
+    Changes are debounced: the callback gets every path (relative to
+    ``root``) that changed, once nothing has changed for ``debounce``
+    seconds, and is never run twice at once. An empty path means that
+    anything might have changed. Directories for which ``skip`` returns
+    True (given their relative path) aren't watched.
+
+    Uses inotify on Linux, otherwise compares file modification times
+    every ``poll_interval`` seconds.
+    """
+
+    def __init__(self, root: Path,
+                 callback: Callable[[Set[Path]], Awaitable[None]],
+                 skip: Callable[[Path], bool] = lambda path: False,
+                 debounce: float = 1.0, poll_interval: float = 5.0) -> None:
+        self.root = root
+        self.callback = callback
+        self.skip = skip
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.pending: Set[Path] = set()
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.running: Optional[asyncio.Task] = None
+        self.fd: Optional[int] = None
+        self.watches: Dict[int, Path] = {} # inotify watch descriptor -> path
+        self.poller: Optional[asyncio.Task] = None
+        self.libc: Optional[ctypes.CDLL] = None
+
+    def start(self) -> None:
+        if sys.platform.startswith('linux'):
+            try:
+                self.start_inotify()
+                logger.info('Watching %s with inotify (%d directories)',
+                            self.root, len(self.watches))
+                return
+            except (OSError, AttributeError) as exc:
+                logger.warning('inotify unavailable, polling instead: %r', exc)
+                self.close_inotify()
+        self.poller = asyncio.create_task(self.poll())
+        logger.info('Watching %s by polling every %ss',
+                    self.root, self.poll_interval)
+
+    def stop(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.poller is not None:
+            self.poller.cancel()
+            self.poller = None
+        self.close_inotify()
+
+    def changed(self, path: Path) -> None:
+        """Note a change, (re)starting the debounce timer."""
+        self.pending.add(path)
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = asyncio.get_running_loop().call_later(
+            self.debounce, self.fire)
+
+    def fire(self) -> None:
+        self.timer = None
+        if self.running is not None and not self.running.done():
+            # let it finish first, then take what piled up meanwhile
+            self.running.add_done_callback(lambda task: self.fire())
+            return
+        if self.pending:
+            paths, self.pending = self.pending, set()
+            self.running = asyncio.create_task(self.run(paths))
+
+    async def run(self, paths: Set[Path]) -> None:
+        try:
+            await self.callback(paths)
+        except Exception:
+            logger.exception('Failed to handle changes to %s:', paths)
+
+    ### inotify ###
+
+    def start_inotify(self) -> None:
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.fd = fd
+        self.watch_tree(Path())
+        asyncio.get_running_loop().add_reader(fd, self.read_events)
+
+    def close_inotify(self) -> None:
+        if self.fd is not None:
+            asyncio.get_running_loop().remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+        self.watches.clear()
+
+    def watch_tree(self, rel: Path) -> None:
+        """Watch a directory and every directory under it."""
+        assert self.libc is not None
+        if self.skip(rel):
+            return
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(self.root / rel), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            if rel == Path():
+                raise OSError(errno, f'Cannot watch {self.root}')
+            logger.warning('Cannot watch %s: %s',
+                           self.root / rel, os.strerror(errno))
+            return
+        self.watches[wd] = rel
+        try:
+            with os.scandir(self.root / rel) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        self.watch_tree(rel / entry.name)
+        except FileNotFoundError:
+            pass # removed again already
+
+    def read_events(self) -> None:
+        try:
+            data = os.read(self.fd, 64 * 1024) # type: ignore
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self.changed(Path()) # missed some, so anything
+                continue
+            rel = self.watches.get(wd)
+            if rel is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd] # directory is gone
+                continue
+            path = rel / os.fsdecode(name) if name else rel
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # its contents may already have changed before it's watched
+                self.watch_tree(path)
+            self.changed(path)
+
+    ### polling ###
+
+    def snapshot(self) -> Dict[Path, Tuple[int, int]]:
+        """Get the modification time and size of every file."""
+        files: Dict[Path, Tuple[int, int]] = {}
+        dirs = [Path()]
+        while dirs:
+            rel = dirs.pop()
+            if self.skip(rel):
+                continue
+            try:
+                with os.scandir(self.root / rel) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(rel / entry.name)
+                        else:
+                            stat = entry.stat()
+                            files[rel / entry.name] = (
+                                stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                continue
+        return files
+
+    async def poll(self) -> None:
+        old = await asyncio.to_thread(self.snapshot)
+        while 1:
+            await asyncio.sleep(self.poll_interval)
+            new = await asyncio.to_thread(self.snapshot)
+            for path in old.keys() | new.keys():
+                if old.get(path) != new.get(path):
+                    self.changed(path)
+            old = new